@@ -0,0 +1,174 @@
+from collections import OrderedDict
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from .http_client import http_client, CHUNK_SIZE
+from .ms_graph_auth import ms_graph_auth
+
+logger = logging.getLogger(__name__)
+
+GRAPH_MESSAGES_URL = "https://graph.microsoft.com/v1.0/me/messages"
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class AttachmentCache:
+    """Downloaded email attachments on disk, keyed by (message id, attachment id) and bounded in size (LRU).
+
+    The attachments of a received message do not change, so a cached file is not validated against the
+    mailbox: it is reused for max_age seconds after its download and then downloaded again."""
+
+    def __init__(self, directory, max_bytes, max_age):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self.entries = None  # (message id, attachment id) -> meta, least recently used first
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.downloads = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, email_id, attachment_id):
+        return os.path.join(self.directory, hashlib.sha256(f"{email_id}:{attachment_id}".encode()).hexdigest())
+
+    def _load_index(self):
+        # rebuilt from the meta files on first use, ordered by last access
+        if self.entries is not None:
+            return
+        entries = []
+        if os.path.isdir(self.directory):
+            for file_name in os.listdir(self.directory):
+                if not file_name.endswith(".json"):
+                    continue
+                meta_path = os.path.join(self.directory, file_name)
+                try:
+                    with open(meta_path) as f:
+                        meta = json.load(f)
+                    entries.append((os.stat(meta_path[:-len(".json")]).st_atime, meta))
+                except (OSError, ValueError):
+                    continue
+        self.entries = OrderedDict(((meta["email_id"], meta["attachment_id"]), meta) for _, meta in sorted(entries, key=lambda entry: entry[0]))
+        self.total_bytes = sum(meta["bytes"] for meta in self.entries.values())
+
+    def _lookup(self, email_id, attachment):
+        with self.lock:
+            self._load_index()
+            meta = self.entries.get((email_id, attachment["id"]))
+            # files cached before downloaded_at was stored are downloaded again
+            if meta is None or time.time() - meta.get("downloaded_at", 0) > self.max_age:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((email_id, attachment["id"]))
+            self.hits += 1
+        path = self._path(email_id, attachment["id"])
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def _store(self, email_id, attachment, tmp_path, size):
+        path = self._path(email_id, attachment["id"])
+        os.replace(tmp_path, path)
+
+        meta = {
+            "email_id": email_id,
+            "attachment_id": attachment["id"],
+            "name": attachment.get("name"),
+            "downloaded_at": time.time(),
+            "bytes": size
+        }
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, f"{path}.json")
+
+        with self.lock:
+            self._load_index()
+            previous = self.entries.pop((email_id, attachment["id"]), None)
+            if previous:
+                self.total_bytes -= previous["bytes"]
+            self.entries[(email_id, attachment["id"])] = meta
+            self.total_bytes += meta["bytes"]
+
+            evicted = []
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                key, old = self.entries.popitem(last=False)
+                self.total_bytes -= old["bytes"]
+                evicted.append(key)
+
+        for key in evicted:
+            _remove(self._path(*key))
+            _remove(f"{self._path(*key)}.json")
+        return path
+
+    async def path(self, global_state: dict, email_id: str, attachment: dict) -> str:
+        """Returns the path of the downloaded attachment, downloading it at most once per (message, attachment)."""
+        path = await asyncio.to_thread(self._lookup, email_id, attachment)
+        if path:
+            return path
+
+        # concurrent requests for the same attachment share one download
+        key = (email_id, attachment["id"])
+        if key not in self.downloads:
+            self.downloads[key] = asyncio.ensure_future(self._download(global_state, email_id, attachment))
+            self.downloads[key].add_done_callback(lambda _: self.downloads.pop(key, None))
+        return await asyncio.shield(self.downloads[key])
+
+    async def _download(self, global_state, email_id, attachment):
+        headers = {"Authorization": f"Bearer {await ms_graph_auth.get_token(global_state)}"}
+        url = f"{GRAPH_MESSAGES_URL}/{email_id}/attachments/{attachment['id']}/$value"
+
+        # streamed to a temporary file chunk by chunk, the attachment is never held in memory
+        await asyncio.to_thread(os.makedirs, self.directory, exist_ok=True)
+        tmp_path = f"{self._path(email_id, attachment['id'])}.{os.getpid()}.download"
+        size = 0
+        try:
+            async with http_client.stream("GET", url, headers=headers) as response:
+                if response.status_code != 200:
+                    raise Exception(f"Error downloading attachment: {response.status_code}")
+                with open(tmp_path, "wb") as f:
+                    async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                        await asyncio.to_thread(f.write, chunk)
+                        size += len(chunk)
+        except BaseException:
+            await asyncio.to_thread(_remove, tmp_path)
+            raise
+
+        return await asyncio.to_thread(self._store, email_id, attachment, tmp_path, size)
+
+    async def read(self, global_state: dict, email_id: str, attachment: dict) -> bytes:
+        path = await self.path(global_state, email_id, attachment)
+        return await asyncio.to_thread(self._read, path)
+
+    @staticmethod
+    def _read(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries or {}),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "max_age": self.max_age,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+# Create a single instance to be used across the application
+attachment_cache = AttachmentCache(
+    directory=os.getenv("ATTACHMENT_CACHE_DIR", "./data/attachments"),
+    max_bytes=int(os.getenv("ATTACHMENT_CACHE_MAX_MB", "512")) * 1024 * 1024,
+    max_age=float(os.getenv("ATTACHMENT_CACHE_MAX_AGE", "86400"))
+)
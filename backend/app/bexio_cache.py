@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import os
+import re
+import time
+import unicodedata
+
+from .http_client import http_client
+
+logger = logging.getLogger(__name__)
+
+ACCOUNT_TYPES = {
+    1: "income",
+    2: "expense",
+    3: "active",
+    4: "passive",
+    5: "complete"
+}
+
+class ReferenceCache:
+    """Bexio reference data shared by all threads, kept for ttl seconds.
+
+    Concurrent misses of the same key share a single load, and writes that change the data (e.g. a
+    new contact) invalidate it explicitly."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+        self.entries = {}
+        self.loads = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key, loader):
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        if key not in self.loads:
+            self.loads[key] = asyncio.ensure_future(self._load(key, loader))
+            self.loads[key].add_done_callback(lambda _: self.loads.pop(key, None))
+        return await asyncio.shield(self.loads[key])
+
+    async def _load(self, key, loader):
+        value = await loader()
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        logger.debug(f"Loaded Bexio reference data {key}")
+        return value
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def stats(self):
+        return {
+            "ttl": self.ttl,
+            "keys": sorted(self.entries),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+def normalize_name(name: str) -> str:
+    # case, accents and punctuation do not matter when looking up a contact by name
+    name = unicodedata.normalize("NFKD", name or "")
+    name = "".join(char for char in name if not unicodedata.combining(char))
+    return " ".join(re.sub(r"[^\w]+", " ", name.casefold()).split())
+
+def _bexio_headers():
+    return {
+        "Accept": "application/json",
+        "Authorization": f"Bearer {os.getenv('BEXIO_PAT')}"
+    }
+
+async def _load_accounts():
+    response = await http_client.get("https://api.bexio.com/2.0/accounts", headers=_bexio_headers())
+    if response.status_code != 200:
+        raise Exception(f"Failed to fetch accounts: {response.status_code} - {response.text}")
+
+    # active accounts only, indexed by account type
+    accounts = [
+        {
+            "id": account["id"],
+            "account_no": account["account_no"],
+            "name": account["name"],
+            "account_type": ACCOUNT_TYPES[account["account_type"]],
+        }
+        for account in response.json() if account["is_active"]
+    ]
+    by_type = {account_type: [] for account_type in ACCOUNT_TYPES.values()}
+    for account in accounts:
+        by_type[account["account_type"]].append(account)
+    return {"all": accounts, "by_type": by_type}
+
+async def _load_contacts():
+    response = await http_client.get("https://api.bexio.com/2.0/contact", headers=_bexio_headers())
+    if response.status_code != 200:
+        raise Exception(f"Failed to fetch contacts: {response.status_code} - {response.text}")
+
+    contacts = [
+        {
+            "id": contact["id"],
+            "name": contact["name_1"],
+            "address": contact["address"],
+            "postcode": contact["postcode"]
+        }
+        for contact in response.json()
+    ]
+    # by full normalized name and by each word of it
+    by_name, by_word = {}, {}
+    for contact in contacts:
+        name = normalize_name(contact["name"])
+        by_name.setdefault(name, []).append(contact)
+        for word in set(name.split()):
+            by_word.setdefault(word, []).append(contact)
+    return {"all": contacts, "by_name": by_name, "by_word": by_word}
+
+async def get_accounts(account_type: str = "all") -> list:
+    accounts = await bexio_cache.get("accounts", _load_accounts)
+    return accounts["all"] if account_type == "all" else accounts["by_type"][account_type]
+
+async def get_contacts(name: str | None = None) -> list:
+    """Returns all contacts, or those matching the name: exactly (after normalization), else containing all of its words."""
+    contacts = await bexio_cache.get("contacts", _load_contacts)
+    if not name:
+        return contacts["all"]
+
+    name = normalize_name(name)
+    if name in contacts["by_name"]:
+        return contacts["by_name"][name]
+
+    candidates = [contacts["by_word"].get(word, []) for word in name.split()]
+    if not candidates:
+        return []
+    ids = set.intersection(*({contact["id"] for contact in words} for words in candidates))
+    return [contact for contact in min(candidates, key=len) if contact["id"] in ids]
+
+# Create a single instance to be used across the application
+bexio_cache = ReferenceCache(ttl=float(os.getenv("BEXIO_CACHE_TTL", "300")))
@@ -0,0 +1,104 @@
+from functools import lru_cache
+import base64
+import hashlib
+import mmap
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+BLOB_REF_PREFIX = "blob:"
+BLOB_URL_PREFIX = "/api/blobs/"
+
+_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+def sniff_mime_type(data) -> str:
+    header = bytes(data[:12])
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    if header.startswith(b"%PDF"):
+        return "application/pdf"
+    return "application/octet-stream"
+
+class BlobStore:
+    """Content addressed files under a data directory, keyed by the sha256 of their bytes.
+
+    Message rows keep blob:<hash> references (and /api/blobs/<hash> URLs for the UI) instead of
+    inline base64 data; the bytes are only read when a payload is built or a blob is served."""
+
+    def __init__(self, root: str, use_mmap: bool = True):
+        self.root = root
+        self.use_mmap = use_mmap
+
+    def path(self, blob_hash: str) -> str:
+        if not _HASH_PATTERN.match(blob_hash):
+            raise ValueError(f"Invalid blob hash: {blob_hash}")
+        return os.path.join(self.root, blob_hash[:2], blob_hash)
+
+    def exists(self, blob_hash: str) -> bool:
+        return os.path.exists(self.path(blob_hash))
+
+    def put(self, data: bytes) -> str:
+        blob_hash = hashlib.sha256(data).hexdigest()
+        path = self.path(blob_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write under a temporary name so readers never see a partial blob
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            logger.debug(f"Stored blob {blob_hash} ({len(data)} bytes)")
+        return blob_hash
+
+    def get(self, blob_hash: str):
+        """Returns the blob contents, memory-mapped when enabled (supports the buffer protocol either way)."""
+        with open(self.path(blob_hash), "rb") as f:
+            if self.use_mmap and os.fstat(f.fileno()).st_size > 0:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return f.read()
+
+    @lru_cache(maxsize=32)
+    def data_url(self, blob_hash: str) -> str:
+        data = self.get(blob_hash)
+        try:
+            return f"data:{sniff_mime_type(data)};base64,{base64.b64encode(data).decode('ascii')}"
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    def resolve_api_messages(self, api_messages: list) -> list:
+        """Replaces blob references in image_url parts with data URLs, without touching the given messages."""
+        resolved = []
+        for api_message in api_messages:
+            content = api_message.get("content")
+            if isinstance(content, list) and any(self._is_blob_image(part) for part in content):
+                content = [
+                    {**part, "image_url": {**part["image_url"], "url": self.data_url(part["image_url"]["url"][len(BLOB_REF_PREFIX):])}}
+                    if self._is_blob_image(part) else part
+                    for part in content
+                ]
+                api_message = {**api_message, "content": content}
+            resolved.append(api_message)
+        return resolved
+
+    @staticmethod
+    def _is_blob_image(part) -> bool:
+        return isinstance(part, dict) and part.get("type") == "image_url" and part["image_url"]["url"].startswith(BLOB_REF_PREFIX)
+
+def blob_ref(blob_hash: str) -> str:
+    return f"{BLOB_REF_PREFIX}{blob_hash}"
+
+def blob_url(blob_hash: str) -> str:
+    return f"{BLOB_URL_PREFIX}{blob_hash}"
+
+# Create a single instance to be used across the application
+blob_store = BlobStore(
+    os.getenv("BLOB_STORE_DIR", "./data/blobs"),
+    use_mmap=os.getenv("BLOB_STORE_MMAP", "true").lower() == "true"
+)
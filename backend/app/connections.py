@@ -1,47 +1,141 @@
-from typing import Dict, Set
+from typing import Dict
 from fastapi import WebSocket
+import asyncio
 import logging
 import json
+import os
 
 logger = logging.getLogger(__name__)
 
+class Connection:
+    """A websocket with its own bounded outbound queue, drained by a writer task."""
+
+    def __init__(self, websocket: WebSocket, thread_id: int, max_queue_size: int):
+        self.websocket = websocket
+        self.thread_id = thread_id
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self.writer_task = None
+        # a degraded connection fell behind and stops receiving message_delta events until it catches up
+        self.degraded = False
+        self.sent = 0
+        self.dropped = 0
+
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, send_timeout=5.0, max_queue_size=100):
         # Store websocket connections per thread
-        self.thread_connections: Dict[int, Set[WebSocket]] = {}
+        self.thread_connections: Dict[int, Dict[WebSocket, Connection]] = {}
+        self.send_timeout = send_timeout
+        self.max_queue_size = max_queue_size
+
+        self.closing = set()  # close handshakes of evicted clients, kept off the broadcast path
+        self.evictions = 0
+        self.downgrades = 0
         logger.info("ConnectionManager initialized")
 
     async def connect(self, websocket: WebSocket, thread_id: int):
         await websocket.accept()
         if thread_id not in self.thread_connections:
-            self.thread_connections[thread_id] = set()
-        self.thread_connections[thread_id].add(websocket)
+            self.thread_connections[thread_id] = {}
+        connection = Connection(websocket, thread_id, self.max_queue_size)
+        connection.writer_task = asyncio.create_task(self._write(connection))
+        self.thread_connections[thread_id][websocket] = connection
         logger.info(f"Client connected to thread {thread_id}. Active connections: {len(self.thread_connections[thread_id])}")
 
     async def disconnect(self, websocket: WebSocket, thread_id: int):
         if thread_id in self.thread_connections:
-            self.thread_connections[thread_id].discard(websocket)
+            connection = self.thread_connections[thread_id].pop(websocket, None)
             if not self.thread_connections[thread_id]:
                 del self.thread_connections[thread_id]
-            logger.info(f"Client disconnected from thread {thread_id}. Remaining connections: {len(self.thread_connections.get(thread_id, set()))}")
+            if connection is not None and connection.writer_task is not asyncio.current_task():
+                connection.writer_task.cancel()
+            logger.info(f"Client disconnected from thread {thread_id}. Remaining connections: {len(self.thread_connections.get(thread_id, {}))}")
+
+    async def _evict(self, connection: Connection, reason: str):
+        logger.warning(f"Evicting slow client from thread {connection.thread_id}: {reason}")
+        self.evictions += 1
+        await self.disconnect(connection.websocket, connection.thread_id)
+        close_task = asyncio.create_task(self._close(connection.websocket))
+        self.closing.add(close_task)
+        close_task.add_done_callback(self.closing.discard)
+
+    async def _close(self, websocket: WebSocket):
+        try:
+            await asyncio.wait_for(websocket.close(code=1013), timeout=self.send_timeout)
+        except Exception:
+            pass
+
+    async def _write(self, connection: Connection):
+        while True:
+            data = await connection.queue.get()
+            try:
+                await asyncio.wait_for(connection.websocket.send_text(data), timeout=self.send_timeout)
+                connection.sent += 1
+            except asyncio.TimeoutError:
+                await self._evict(connection, f"send timed out after {self.send_timeout} seconds")
+                return
+            except Exception as e:
+                logger.error(f"Failed to send message to client in thread {connection.thread_id}: {str(e)}")
+                await self.disconnect(connection.websocket, connection.thread_id)
+                return
+
+            if connection.degraded and connection.queue.empty():
+                logger.info(f"Client in thread {connection.thread_id} caught up, resuming message deltas")
+                connection.degraded = False
 
     async def broadcast_to_thread(self, thread_id: int, message: dict):
         if thread_id in self.thread_connections:
-            logger.info(f"Broadcasting to thread {thread_id}. Active connections: {len(self.thread_connections[thread_id])}")
-            disconnected_ws = set()
-            for websocket in self.thread_connections[thread_id]:
+            logger.debug(f"Broadcasting to thread {thread_id}. Active connections: {len(self.thread_connections[thread_id])}")
+            # Serialize once, every connection gets the same text frame
+            data = json.dumps(message)
+            is_delta = message.get("event_type") == "message_delta"
+
+            slow_connections = []
+            for connection in list(self.thread_connections[thread_id].values()):
+                if is_delta and connection.degraded:
+                    connection.dropped += 1
+                    continue
                 try:
-                    await websocket.send_json(message)
-                    logger.info(f"Successfully sent message to a client in thread {thread_id}")
-                except Exception as e:
-                    logger.error(f"Failed to send message to client in thread {thread_id}: {str(e)}")
-                    disconnected_ws.add(websocket)
-            
-            # Clean up disconnected websockets
-            for ws in disconnected_ws:
-                await self.disconnect(ws, thread_id)
+                    connection.queue.put_nowait(data)
+                except asyncio.QueueFull:
+                    connection.dropped += 1
+                    if is_delta:
+                        # deltas are superseded by the persisted message, so the client is downgraded instead of evicted
+                        logger.warning(f"Client in thread {thread_id} is falling behind, pausing message deltas")
+                        connection.degraded = True
+                        self.downgrades += 1
+                    else:
+                        slow_connections.append(connection)
+
+            for connection in slow_connections:
+                await self._evict(connection, f"outbound queue full ({self.max_queue_size} messages)")
+
+            # let the writers run before the next broadcast so bursts don't fill healthy queues
+            await asyncio.sleep(0)
         else:
             logger.warning(f"No active connections for thread {thread_id}")
 
+    def stats(self):
+        return {
+            "send_timeout": self.send_timeout,
+            "max_queue_size": self.max_queue_size,
+            "evictions": self.evictions,
+            "downgrades": self.downgrades,
+            "threads": {
+                thread_id: [
+                    {
+                        "queue_depth": connection.queue.qsize(),
+                        "degraded": connection.degraded,
+                        "sent": connection.sent,
+                        "dropped": connection.dropped
+                    }
+                    for connection in connections.values()
+                ]
+                for thread_id, connections in self.thread_connections.items()
+            }
+        }
+
 # Create a single instance to be used across the application
-manager = ConnectionManager() 
\ No newline at end of file
+manager = ConnectionManager(
+    send_timeout=float(os.getenv("WS_SEND_TIMEOUT", "5.0")),
+    max_queue_size=int(os.getenv("WS_MAX_QUEUE_SIZE", "100"))
+)
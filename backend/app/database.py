@@ -1,12 +1,47 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+import logging
+import os
+
+logger = logging.getLogger(__name__)
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
 
+# Connection pragmas per storage profile. "wal" lets readers run while a writer commits,
+# "default" keeps SQLite's rollback journal and full fsync.
+STORAGE_PROFILES = {
+    "default": {},
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,  # ms to wait for a lock instead of failing with "database is locked"
+        "mmap_size": 268435456,  # 256 MB
+        "cache_size": -65536,  # 64 MB
+        "temp_store": "MEMORY"
+    }
+}
+STORAGE_PROFILE = os.getenv("DB_STORAGE_PROFILE", "wal")
+if STORAGE_PROFILE not in STORAGE_PROFILES:
+    raise ValueError(f"Invalid storage profile: {STORAGE_PROFILE}")
+
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "20")),
+    pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "30"))
 )
+
+@event.listens_for(engine, "connect")
+def _apply_storage_profile(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in STORAGE_PROFILES[STORAGE_PROFILE].items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -17,7 +52,66 @@ def get_db():
     try:
         yield db
     finally:
-        db.close() 
-        
+        db.close()
+
 def get_db_session():
-    return SessionLocal()
\ No newline at end of file
+    return SessionLocal()
+
+def migrate(engine):
+    """Adds columns and indexes that were introduced after an existing database file was created.
+
+    create_all only creates missing tables, so older sql_app.db files are brought up to date here."""
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=engine.dialect)}"
+                if column.default is not None and column.default.is_scalar:
+                    ddl += f" NOT NULL DEFAULT {column.default.arg!r}"
+                logger.info(f"Migrating database: {ddl}")
+                connection.execute(text(ddl))
+
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+
+            logger.info(f"Migrating database: creating index {index.name} on {table.name}")
+            try:
+                with engine.begin() as connection:
+                    index.create(bind=connection)
+            except Exception as e:
+                # e.g. duplicate tool_call_ids in an old database prevent the unique index
+                logger.warning(f"Could not create index {index.name}: {str(e)}")
+
+_SQLITE_PRAGMA_NAMES = {
+    "synchronous": {0: "OFF", 1: "NORMAL", 2: "FULL", 3: "EXTRA"},
+    "temp_store": {0: "DEFAULT", 1: "FILE", 2: "MEMORY"}
+}
+
+def check_storage_settings(engine):
+    """Reads back the effective connection settings and logs any that differ from the storage profile."""
+    settings = {"profile": STORAGE_PROFILE, "pool": engine.pool.status()}
+    with engine.connect() as connection:
+        for pragma in ("journal_mode", "synchronous", "busy_timeout", "mmap_size", "cache_size", "temp_store"):
+            value = connection.exec_driver_sql(f"PRAGMA {pragma}").scalar()
+            settings[pragma] = _SQLITE_PRAGMA_NAMES.get(pragma, {}).get(value, value)
+
+    for pragma, expected in STORAGE_PROFILES[STORAGE_PROFILE].items():
+        if str(settings[pragma]).upper() != str(expected).upper():
+            logger.warning(f"Storage setting {pragma} is {settings[pragma]}, expected {expected}")
+
+    logger.info(f"Storage settings: {settings}")
+    return settings
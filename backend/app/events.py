@@ -2,10 +2,149 @@ from sqlalchemy import event
 from .models import Message
 from .connections import manager
 import asyncio
+import itertools
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
+class EventBus:
+    """In-process bus that carries ORM message events to the websocket connections.
+
+    publish() may be called from any thread; events are handed to the server loop with
+    call_soon_threadsafe and fanned out by a single consumer task. Pending events for the same
+    message are coalesced and a full queue drops either the oldest or the newest update. Inserts are
+    never dropped, a client that misses one never shows the row, while a dropped update is replaced by
+    the next one or the next fetch."""
+
+    def __init__(self, max_queue_size=1000, overflow_policy="drop_oldest", coalesce=True):
+        if overflow_policy not in ("drop_oldest", "drop_newest"):
+            raise ValueError(f"Invalid overflow policy: {overflow_policy}")
+
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        self.coalesce = coalesce
+
+        self.loop = None
+        self.queue = None
+        self.consumer_task = None
+        self.pending = {}  # queue key -> (thread_id, event_data)
+        self.sequence = itertools.count()
+
+        self.published = 0
+        self.delivered = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        # bounded by the pending events, dropped keys stay in the queue and are skipped by the consumer
+        self.queue = asyncio.Queue()
+        self.consumer_task = self.loop.create_task(self._consume())
+        logger.info(f"Event bus started (max_queue_size={self.max_queue_size}, overflow_policy={self.overflow_policy}, coalesce={self.coalesce})")
+
+    async def stop(self):
+        if self.consumer_task is not None:
+            self.consumer_task.cancel()
+            try:
+                await self.consumer_task
+            except asyncio.CancelledError:
+                pass
+        self.loop = None
+        self.consumer_task = None
+
+    def publish(self, thread_id, event_data):
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            logger.warning(f"Event bus is not running, dropping event for thread {thread_id}")
+            self.dropped += 1
+            return
+        loop.call_soon_threadsafe(self._enqueue, thread_id, event_data)
+
+    def _enqueue(self, thread_id, event_data):
+        self.published += 1
+
+        message_id = event_data.get("message", {}).get("id")
+        if self.coalesce and message_id is not None:
+            key = (thread_id, message_id)
+            if key in self.pending:
+                # keep the original event type so an insert followed by updates still arrives as an insert
+                self.pending[key][1]["message"] = event_data["message"]
+                self.coalesced += 1
+                return
+        else:
+            key = next(self.sequence)
+
+        if len(self.pending) >= self.max_queue_size:
+            dropped_key = self._overflow_victim(key, event_data)
+            if dropped_key == key:
+                self.dropped += 1
+                logger.warning(f"Event queue full, dropping new event for thread {thread_id}")
+                return
+            if dropped_key is None:
+                logger.warning(f"Event queue full of inserts, queueing insert for thread {thread_id} anyway")
+            else:
+                self.dropped += 1
+                self.pending.pop(dropped_key)
+                logger.warning(f"Event queue full, dropped event {dropped_key}")
+
+        self.pending[key] = (thread_id, event_data)
+        self.queue.put_nowait(key)
+        self.max_depth = max(self.max_depth, len(self.pending))
+
+    @staticmethod
+    def _droppable(event_data):
+        return event_data.get("event_type") != "message_insert"
+
+    def _overflow_victim(self, key, event_data):
+        # the key of the event to drop for the new one, None if every event has to be kept
+        if self.overflow_policy == "drop_newest" and self._droppable(event_data):
+            return key
+        # pending keeps the queue order, the first droppable entry is the oldest
+        oldest = next((pending_key for pending_key, (_, pending_data) in self.pending.items() if self._droppable(pending_data)), None)
+        if oldest is not None:
+            return oldest
+        return key if self._droppable(event_data) else None
+
+    async def _consume(self):
+        while True:
+            key = await self.queue.get()
+            entry = self.pending.pop(key, None)
+            if entry is None:
+                # dropped while it was queued
+                continue
+            thread_id, event_data = entry
+            try:
+                await manager.broadcast_to_thread(thread_id, event_data)
+                self.delivered += 1
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Error broadcasting event for thread {thread_id}: {str(e)}")
+
+    def stats(self):
+        return {
+            "running": self.consumer_task is not None and not self.consumer_task.done(),
+            "depth": len(self.pending),
+            "max_depth": self.max_depth,
+            "max_queue_size": self.max_queue_size,
+            "overflow_policy": self.overflow_policy,
+            "coalesce": self.coalesce,
+            "published": self.published,
+            "delivered": self.delivered,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "errors": self.errors
+        }
+
+# Create a single instance to be used across the application
+event_bus = EventBus(
+    max_queue_size=int(os.getenv("EVENT_BUS_MAX_QUEUE_SIZE", "1000")),
+    overflow_policy=os.getenv("EVENT_BUS_OVERFLOW_POLICY", "drop_oldest"),
+    coalesce=os.getenv("EVENT_BUS_COALESCE", "true").lower() == "true"
+)
+
 def setup_db_events(db):
     def handle_message_event(mapper, connection, message, event_type='message_update'):
         try:
@@ -35,23 +174,9 @@ def setup_db_events(db):
                 "message": message_dict
             }
             
-            # Create a new event loop in a separate thread for the broadcast
-            def run_broadcast():
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                try:
-                    loop.run_until_complete(manager.broadcast_to_thread(thread_id, event_data))
-                finally:
-                    loop.close()
-            
-            # Run the broadcast in a separate thread
-            import threading
-            thread = threading.Thread(target=run_broadcast)
-            thread.start()
-            
-            # manager.broadcast_to_thread(thread_id, event_data)
+            event_bus.publish(thread_id, event_data)
             
-            logger.info(f"Broadcast message sent for thread {thread_id}: {event_data}")
+            logger.debug(f"Message event queued for thread {thread_id}: {event_data}")
         except Exception as e:
             logger.error(f"Error in message {event_type} event handler: {str(e)}")
 
@@ -0,0 +1,157 @@
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+import asyncio
+import importlib.util
+import logging
+import os
+import random
+import weakref
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+CHUNK_SIZE = 1024 * 1024
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+class HttpClient:
+    """Shared async HTTP layer for the tools: one pooled keep-alive client per host, with timeouts and
+    retries with backoff on 429/5xx.
+
+    httpx clients are bound to the event loop they first ran on, so the pools are kept per loop."""
+
+    def __init__(self, timeout, connect_timeout, max_connections, max_keepalive_connections, max_retries, backoff, http2):
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("HTTP/2 requested but the h2 package is not installed, falling back to HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+
+        self.clients = weakref.WeakKeyDictionary()
+        self.requests = {}
+        self.retries = {}
+
+    def client(self, host) -> httpx.AsyncClient:
+        loop_clients = self.clients.setdefault(asyncio.get_running_loop(), {})
+        if host not in loop_clients:
+            loop_clients[host] = httpx.AsyncClient(timeout=self.timeout, limits=self.limits, http2=self.http2)
+        return loop_clients[host]
+
+    def _retry_delay(self, attempt, response=None):
+        if response is not None and "Retry-After" in response.headers:
+            try:
+                return float(response.headers["Retry-After"])
+            except ValueError:
+                pass
+        return self.backoff * 2 ** attempt * (0.5 + random.random())
+
+    async def request(self, method, url, stream=False, content_factory=None, **kwargs) -> httpx.Response:
+        """Sends a request with retries. With stream=True the body is left unread (see stream()); a
+        content_factory builds a fresh streamed request body for every attempt."""
+        method = method.upper()
+        host = urlsplit(url).netloc
+        client = self.client(host)
+
+        attempt = 0
+        while True:
+            self.requests[host] = self.requests.get(host, 0) + 1
+            if content_factory:
+                kwargs["content"] = content_factory()
+            try:
+                response = await client.send(client.build_request(method, url, **kwargs), stream=stream)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.ReadTimeout, httpx.RemoteProtocolError) as e:
+                # a failed connect never reached the server, anything else is only safe to repeat if idempotent
+                retryable = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)) or method in IDEMPOTENT_METHODS
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning(f"{method} {host} failed with {type(e).__name__}, retrying in {delay:.1f}s")
+            else:
+                # 5xx responses of non-idempotent requests may have been processed, only 429 is safe to repeat
+                retryable = response.status_code == 429 or (response.status_code in RETRY_STATUS_CODES and method in IDEMPOTENT_METHODS)
+                if not retryable or attempt >= self.max_retries:
+                    return response
+                delay = self._retry_delay(attempt, response)
+                logger.warning(f"{method} {host} returned {response.status_code}, retrying in {delay:.1f}s")
+                await response.aclose()
+
+            self.retries[host] = self.retries.get(host, 0) + 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def stream(self, method, url, **kwargs):
+        """Like request(), but the response body is read by the caller, e.g. with aiter_bytes()."""
+        response = await self.request(method, url, stream=True, **kwargs)
+        try:
+            yield response
+        finally:
+            await response.aclose()
+
+    async def get(self, url, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def aclose(self):
+        loop_clients = self.clients.pop(asyncio.get_running_loop(), {})
+        for client in loop_clients.values():
+            await client.aclose()
+
+    def stats(self):
+        return {
+            "http2": self.http2,
+            "requests": dict(self.requests),
+            "retries": dict(self.retries),
+            "open_clients": sum(len(loop_clients) for loop_clients in self.clients.values())
+        }
+
+def multipart_file(field, file_name, path, content_type="application/octet-stream", on_progress=None):
+    """Returns (headers, content_factory) for a multipart/form-data body holding a single file.
+
+    The file is read from disk in CHUNK_SIZE chunks while the request is sent, so memory use does not
+    depend on the file size. on_progress(sent, total) is called after each chunk."""
+    boundary = os.urandom(16).hex()
+    quoted_name = file_name.replace("\\", "\\\\").replace('"', "%22")
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{field}"; filename="{quoted_name}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    size = os.path.getsize(path)
+
+    headers = {
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+        "Content-Length": str(len(head) + size + len(tail))
+    }
+
+    async def content():
+        yield head
+        sent = 0
+        with open(path, "rb") as f:
+            while chunk := await asyncio.to_thread(f.read, CHUNK_SIZE):
+                sent += len(chunk)
+                yield chunk
+                if on_progress:
+                    on_progress(sent, size)
+        yield tail
+
+    return headers, content
+
+# Create a single instance to be used across the application
+http_client = HttpClient(
+    timeout=float(os.getenv("HTTP_TIMEOUT", "30")),
+    connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT", "10")),
+    max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "20")),
+    max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10")),
+    max_retries=int(os.getenv("HTTP_MAX_RETRIES", "3")),
+    backoff=float(os.getenv("HTTP_RETRY_BACKOFF", "0.5")),
+    http2=os.getenv("HTTP_HTTP2", "true").lower() == "true"
+)
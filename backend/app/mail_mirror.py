@@ -0,0 +1,268 @@
+from datetime import datetime, timedelta, timezone
+import asyncio
+import json
+import logging
+import os
+import time
+
+from sqlalchemy.dialects.sqlite import insert
+
+from .models import MailMessage, MailSyncState
+from . import database as db
+from .http_client import http_client
+from .ms_graph_auth import ms_graph_auth
+
+logger = logging.getLogger(__name__)
+
+GRAPH_DELTA_URL = "https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages/delta"
+GRAPH_BATCH_URL = "https://graph.microsoft.com/v1.0/$batch"
+GRAPH_BATCH_SIZE = 20  # most requests Graph accepts in one $batch
+MESSAGE_FIELDS = "id,subject,from,receivedDateTime,hasAttachments,bodyPreview"
+ATTACHMENT_FIELDS = ("id", "name", "contentType", "size")
+MAX_UNMIRRORED_ATTACHMENT_LISTS = 1000
+
+def _graph_datetime(dt: datetime) -> str:
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+class MailMirror:
+    """SQLite mirror of the inbox per account, fed by Graph delta queries.
+
+    The first sync of an account pages through the inbox back to initial_days; after that each sync
+    follows the stored delta link and only transfers what changed. A sync younger than max_age
+    seconds is reused, so repeated lookups within a thread are answered from the database. Attachment
+    lists are fetched with $batch requests on first lookup, and fetched again after their message changed."""
+
+    def __init__(self, initial_days, max_age, page_size, attachment_concurrency):
+        self.initial_days = initial_days
+        self.max_age = max_age
+        self.page_size = page_size
+        self.attachment_concurrency = attachment_concurrency
+
+        self.locks = {}
+        self.last_sync = {}
+        self.unmirrored_attachments = {}  # attachment lists of messages outside the mirrored window
+        self.syncs = 0
+        self.changes = 0
+        self.attachment_requests = 0
+
+    @staticmethod
+    def account(global_state: dict) -> str:
+        return global_state.get("ms_graph.account") or global_state.get("ms_graph.email") or global_state["ms_graph.client_id"]
+
+    async def sync(self, global_state: dict, since: datetime | None = None, on_update=None):
+        """Brings the mirror of the thread's account up to date, covering at least messages received since `since`."""
+        account = self.account(global_state)
+        initial_str = _graph_datetime(datetime.now(timezone.utc) - timedelta(days=self.initial_days))
+        since_str = _graph_datetime(since) if since else initial_str
+
+        lock = self.locks.setdefault(account, asyncio.Lock())
+        async with lock:
+            with db.SessionLocal() as session:
+                state = session.query(MailSyncState).filter(MailSyncState.account == account).first()
+                delta_link = state.delta_link if state else None
+                covered = delta_link is not None and state.since <= since_str
+                if covered and time.monotonic() - self.last_sync.get(account, float("-inf")) < self.max_age:
+                    return
+                mirror_since = state.since if covered else min(since_str, state.since if state else initial_str)
+
+            changes = 0
+            if covered:
+                delta_link, changes = await self._follow_delta(global_state, account, delta_link, None, on_update)
+                if delta_link is None:
+                    logger.info(f"Delta link of {account} expired, resyncing the mailbox mirror")
+
+            if delta_link is None or not covered:
+                # no delta link yet or the mirror does not reach back far enough: start a new delta round
+                params = {"$select": MESSAGE_FIELDS, "$filter": f"receivedDateTime ge {mirror_since}"}
+                seen = set()
+                delta_link, changes = await self._follow_delta(global_state, account, GRAPH_DELTA_URL, params, on_update, seen)
+                if delta_link is None:
+                    raise Exception("Error syncing emails: the mailbox delta round expired")
+
+                # a full round lists every message in the window, anything else was deleted in the meantime
+                with db.SessionLocal() as session:
+                    session.query(MailMessage).filter(
+                        MailMessage.account == account,
+                        MailMessage.received_at >= mirror_since,
+                        MailMessage.id.not_in(seen)
+                    ).delete(synchronize_session=False)
+                    session.commit()
+
+            with db.SessionLocal() as session:
+                state = session.query(MailSyncState).filter(MailSyncState.account == account).first()
+                if state is None:
+                    state = MailSyncState(account=account)
+                    session.add(state)
+                state.delta_link = delta_link
+                state.since = mirror_since
+                state.synced_at = datetime.now(timezone.utc)
+                session.commit()
+
+            self.last_sync[account] = time.monotonic()
+            self.syncs += 1
+            self.changes += changes
+            logger.debug(f"Synced mailbox mirror of {account}: {changes} changes")
+
+    async def _follow_delta(self, global_state, account, url, params, on_update, seen=None):
+        headers = {
+            "Authorization": f"Bearer {await ms_graph_auth.get_token(global_state)}",
+            "Prefer": f"odata.maxpagesize={self.page_size}"
+        }
+        changes = 0
+        while True:
+            response = await http_client.get(url, headers=headers, params=params)
+            if response.status_code == 410:
+                return None, changes
+            if response.status_code != 200:
+                raise Exception(f"Error syncing emails: {response.json()}")
+
+            response_data = response.json()
+            page = response_data.get("value", [])
+            changes += self._apply(account, page)
+            if seen is not None:
+                seen.update(change["id"] for change in page if "@removed" not in change)
+
+            if "@odata.deltaLink" in response_data:
+                return response_data["@odata.deltaLink"], changes
+
+            # Parameters are included in the nextLink URL
+            url, params = response_data["@odata.nextLink"], None
+            if on_update:
+                on_update(changes)
+
+    def _apply(self, account, changes):
+        if not changes:
+            return 0
+
+        with db.SessionLocal() as session:
+            removed = [change["id"] for change in changes if "@removed" in change]
+            if removed:
+                session.query(MailMessage).filter(MailMessage.account == account, MailMessage.id.in_(removed)).delete(synchronize_session=False)
+
+            rows = [{
+                "account": account,
+                "id": change["id"],
+                "subject": change.get("subject"),
+                "from_address": (change.get("from") or {}).get("emailAddress", {}).get("address"),
+                "received_at": change["receivedDateTime"],
+                "has_attachments": int(bool(change.get("hasAttachments"))),
+                "body_preview": change.get("bodyPreview"),
+                "attachments": None
+            } for change in changes if "@removed" not in change and "receivedDateTime" in change]
+            if rows:
+                statement = insert(MailMessage).values(rows)
+                # a changed message also resets its attachment list, it is fetched again on the next lookup
+                session.execute(statement.on_conflict_do_update(
+                    index_elements=["account", "id"],
+                    set_={column: statement.excluded[column] for column in rows[0] if column not in ("account", "id")}
+                ))
+            session.commit()
+        for change in changes:
+            self.unmirrored_attachments.pop((account, change["id"]), None)
+        return len(changes)
+
+    def list_messages(self, global_state: dict, since: datetime | None = None, only_has_attachments: bool = False, limit: int | None = None) -> list[MailMessage]:
+        with db.SessionLocal() as session:
+            query = session.query(MailMessage).filter(MailMessage.account == self.account(global_state))
+            if since:
+                query = query.filter(MailMessage.received_at >= _graph_datetime(since))
+            if only_has_attachments:
+                query = query.filter(MailMessage.has_attachments == 1)
+            query = query.order_by(MailMessage.received_at.desc())
+            if limit:
+                query = query.limit(limit)
+            return query.all()
+
+    async def attachments(self, global_state: dict, email_ids: list[str]) -> dict:
+        """Returns the attachment list per message, fetching (and mirroring) the lists that are not known yet."""
+        account = self.account(global_state)
+        with db.SessionLocal() as session:
+            rows = session.query(MailMessage.id, MailMessage.attachments).filter(
+                MailMessage.account == account, MailMessage.id.in_(email_ids)
+            ).all()
+        attachments = {email_id: json.loads(cached) for email_id, cached in rows if cached is not None}
+        attachments.update({
+            email_id: self.unmirrored_attachments[(account, email_id)]
+            for email_id in email_ids if (account, email_id) in self.unmirrored_attachments
+        })
+
+        missing = [email_id for email_id in email_ids if email_id not in attachments]
+        if missing:
+            headers = {"Authorization": f"Bearer {await ms_graph_auth.get_token(global_state)}"}
+            # up to GRAPH_BATCH_SIZE lists per $batch request, with few batches in flight: Graph allows
+            # only a handful of concurrent requests per mailbox
+            semaphore = asyncio.Semaphore(self.attachment_concurrency)
+            async def fetch(batch):
+                async with semaphore:
+                    return await self._fetch_attachment_lists(headers, batch)
+            batches = [missing[i:i + GRAPH_BATCH_SIZE] for i in range(0, len(missing), GRAPH_BATCH_SIZE)]
+            for fetched in await asyncio.gather(*(fetch(batch) for batch in batches)):
+                attachments.update(fetched)
+
+            with db.SessionLocal() as session:
+                for email_id in missing:
+                    updated = session.query(MailMessage).filter(MailMessage.account == account, MailMessage.id == email_id) \
+                        .update({MailMessage.attachments: json.dumps(attachments[email_id])}, synchronize_session=False)
+                    if not updated:
+                        self.unmirrored_attachments[(account, email_id)] = attachments[email_id]
+                        if len(self.unmirrored_attachments) > MAX_UNMIRRORED_ATTACHMENT_LISTS:
+                            del self.unmirrored_attachments[next(iter(self.unmirrored_attachments))]
+                session.commit()
+
+        return attachments
+
+    async def _fetch_attachment_lists(self, headers, email_ids):
+        """Fetches the attachment lists of up to GRAPH_BATCH_SIZE messages with one $batch request,
+        repeating the requests that Graph throttled."""
+        lists = {}
+        pending = list(email_ids)
+        attempt = 0
+        while pending:
+            requests = [{
+                "id": str(i),
+                "method": "GET",
+                "url": f"/me/messages/{email_id}/attachments?$select={','.join(ATTACHMENT_FIELDS)}"
+            } for i, email_id in enumerate(pending)]
+            response = await http_client.post(GRAPH_BATCH_URL, headers=headers, json={"requests": requests})
+            self.attachment_requests += 1
+            if response.status_code != 200:
+                raise Exception(f"Error fetching attachment metadata: {response.json()}")
+
+            throttled, retry_after = [], 0.0
+            for item in response.json().get("responses", []):
+                email_id = pending[int(item["id"])]
+                if item["status"] == 429 and attempt < http_client.max_retries:
+                    throttled.append(email_id)
+                    try:
+                        retry_after = max(retry_after, float((item.get("headers") or {}).get("Retry-After", 0)))
+                    except ValueError:
+                        pass
+                elif item["status"] != 200:
+                    raise Exception(f"Error fetching attachment metadata: {item.get('body')}")
+                else:
+                    lists[email_id] = [{key: att.get(key) for key in ATTACHMENT_FIELDS} for att in item["body"].get("value", [])]
+
+            pending = throttled
+            if pending:
+                attempt += 1
+                delay = retry_after or http_client.backoff * 2 ** attempt
+                logger.warning(f"{len(pending)} attachment list requests were throttled, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+        return lists
+
+    async def find_attachment(self, global_state: dict, email_id: str, attachment_name: str | None = None, attachment_id: str | None = None) -> dict | None:
+        for attachment in (await self.attachments(global_state, [email_id]))[email_id]:
+            if attachment["name"] == attachment_name or attachment["id"] == attachment_id:
+                return attachment
+        return None
+
+    def stats(self):
+        return {"accounts": len(self.last_sync), "syncs": self.syncs, "changes": self.changes, "attachment_requests": self.attachment_requests}
+
+# Create a single instance to be used across the application
+mail_mirror = MailMirror(
+    initial_days=int(os.getenv("MAIL_MIRROR_INITIAL_DAYS", "90")),
+    max_age=float(os.getenv("MAIL_MIRROR_MAX_AGE", "30")),
+    page_size=int(os.getenv("MAIL_MIRROR_PAGE_SIZE", "100")),
+    attachment_concurrency=int(os.getenv("MAIL_MIRROR_ATTACHMENT_CONCURRENCY", "2"))
+)
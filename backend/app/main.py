@@ -3,7 +3,17 @@ from fastapi.middleware.cors import CORSMiddleware
 from . import models, database
 from .services import agent_endpoint
 from .database import engine
-from .events import setup_db_events
+from .events import setup_db_events, event_bus
+from .connections import manager
+from .pdf_render import pdf_renderer
+from .http_client import http_client
+from .ms_graph_auth import ms_graph_auth
+from .mail_mirror import mail_mirror
+from .attachment_cache import attachment_cache
+from .bexio_cache import bexio_cache
+from .tool_memo import tool_memo
+from .services.context import context_stats
+from .services.prompt_cache import prompt_cache_stats
 import logging
 
 # Configure logging
@@ -23,13 +33,79 @@ app.add_middleware(
 
 # Create database tables
 models.Base.metadata.create_all(bind=database.engine)
+database.migrate(database.engine)
+database.check_storage_settings(database.engine)
 
 # Setup database event listeners
 setup_db_events(engine)
 
+@app.on_event("startup")
+async def start_event_bus():
+    event_bus.start()
+
+@app.on_event("shutdown")
+async def stop_event_bus():
+    await event_bus.stop()
+
+@app.on_event("shutdown")
+def stop_pdf_renderer():
+    pdf_renderer.shutdown()
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
+
 # Include the agent_endpoint router
 app.include_router(agent_endpoint.router)
 
 @app.get("/api/health")
 async def health_check():
-    return {"status": "healthy", "message": "FastAPI backend is running!"} 
\ No newline at end of file
+    return {"status": "healthy", "message": "FastAPI backend is running!"}
+
+@app.get("/api/stats/events")
+async def event_stats():
+    return event_bus.stats()
+
+@app.get("/api/stats/connections")
+async def connection_stats():
+    return manager.stats()
+
+@app.get("/api/stats/database")
+async def database_stats():
+    return database.check_storage_settings(database.engine)
+
+@app.get("/api/stats/pdf_render")
+async def pdf_render_stats():
+    return pdf_renderer.stats()
+
+@app.get("/api/stats/http")
+async def http_stats():
+    return http_client.stats()
+
+@app.get("/api/stats/ms_graph_auth")
+async def ms_graph_auth_stats():
+    return ms_graph_auth.stats()
+
+@app.get("/api/stats/mail_mirror")
+async def mail_mirror_stats():
+    return mail_mirror.stats()
+
+@app.get("/api/stats/attachments")
+async def attachment_stats():
+    return attachment_cache.stats()
+
+@app.get("/api/stats/bexio_cache")
+async def bexio_cache_stats():
+    return bexio_cache.stats()
+
+@app.get("/api/stats/tool_memo")
+async def tool_memo_stats():
+    return tool_memo.stats()
+
+@app.get("/api/stats/context")
+async def context_window_stats():
+    return context_stats.stats()
+
+@app.get("/api/stats/prompt_cache")
+async def prompt_cache_usage():
+    return prompt_cache_stats.stats()
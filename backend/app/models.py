@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, Index, event
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -18,6 +18,12 @@ class Thread(Base):
     
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # thread history in conversation order and the latest message of a thread
+        Index("ix_messages_thread_created_id", "thread_id", "created_at", "id"),
+        # tool call updates and finalization
+        Index("ux_messages_tool_call_id", "tool_call_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     
@@ -25,6 +31,7 @@ class Message(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     
     api_messages = Column(Text, nullable=False) # list of message for the API as json
+    token_count = Column(Integer, nullable=True) # estimated prompt tokens of api_messages
     
     agent_state = Column(String(10), nullable=False) # await_input, await_ai_response, await_tool_response
     role = Column(String(10), nullable=False) # user, agent, tool
@@ -39,6 +46,42 @@ class Message(Base):
     tool_state = Column(String(10), nullable=True) # running, completed, error
     tool_result = Column(Text, nullable=True)
     
+    # Bumped on every update so cached copies of the row can be validated cheaply
+    version = Column(Integer, nullable=False, default=1)
+    
     # Relationship with thread
     thread = relationship("Thread", back_populates="messages")
 
+
+@event.listens_for(Message, "before_update")
+def _bump_message_version(mapper, connection, message):
+    message.version = (message.version or 0) + 1
+
+
+
+class MailMessage(Base):
+    """Local mirror of a mailbox folder, kept up to date with Graph delta queries."""
+    __tablename__ = "mail_messages"
+    __table_args__ = (
+        # newest messages of an account first
+        Index("ix_mail_messages_account_received", "account", "received_at"),
+    )
+
+    account = Column(String, primary_key=True)
+    id = Column(String, primary_key=True)  # Graph message id
+
+    subject = Column(Text, nullable=True)
+    from_address = Column(String, nullable=True)
+    received_at = Column(String, nullable=False)  # ISO 8601 as returned by Graph, sorts chronologically
+    has_attachments = Column(Integer, nullable=False, default=0)
+    body_preview = Column(Text, nullable=True)
+    attachments = Column(Text, nullable=True)  # json list of {id, name, contentType, size}, null until fetched
+
+
+class MailSyncState(Base):
+    __tablename__ = "mail_sync_state"
+
+    account = Column(String, primary_key=True)
+    delta_link = Column(Text, nullable=True)
+    since = Column(String, nullable=False)  # oldest receivedDateTime covered by the mirror
+    synced_at = Column(DateTime(timezone=True), nullable=True)
@@ -0,0 +1,133 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import msal
+
+logger = logging.getLogger(__name__)
+
+SCOPES = ["Mail.Read"]
+
+class MSGraphAuth:
+    """MSAL clients with a persistent token cache per tenant/client, shared by all threads.
+
+    Tokens are served from memory while they are fresh, refreshed silently (through the cached
+    refresh token) once they get within refresh_margin seconds of expiry, and only a thread that has
+    never signed in on this tenant/client/account has to go through the device code flow."""
+
+    def __init__(self, cache_dir, refresh_margin):
+        self.cache_dir = cache_dir
+        self.refresh_margin = refresh_margin
+
+        self.apps = {}
+        self.caches = {}
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.silent_hits = 0
+        self.silent_acquisitions = 0
+
+    def _cache_path(self, tenant_id, client_id):
+        key = hashlib.sha256(f"{tenant_id}:{client_id}".encode()).hexdigest()[:32]
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _get_app(self, tenant_id, client_id) -> msal.PublicClientApplication:
+        # msal resolves the authority over the network, run this off the event loop
+        with self.lock:
+            if (tenant_id, client_id) not in self.apps:
+                cache = msal.SerializableTokenCache()
+                path = self._cache_path(tenant_id, client_id)
+                if os.path.exists(path):
+                    with open(path) as f:
+                        cache.deserialize(f.read())
+
+                self.caches[(tenant_id, client_id)] = cache
+                self.apps[(tenant_id, client_id)] = msal.PublicClientApplication(
+                    client_id,
+                    authority=f"https://login.microsoftonline.com/{tenant_id}",
+                    token_cache=cache
+                )
+            return self.apps[(tenant_id, client_id)]
+
+    def _persist(self, tenant_id, client_id):
+        with self.lock:
+            cache = self.caches[(tenant_id, client_id)]
+            if not cache.has_state_changed:
+                return
+
+            path = self._cache_path(tenant_id, client_id)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            # the cache holds refresh tokens, keep it readable by the server user only
+            with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+                f.write(cache.serialize())
+            os.replace(tmp_path, path)
+            cache.has_state_changed = False
+
+    async def get_app(self, global_state: dict) -> msal.PublicClientApplication:
+        return await asyncio.to_thread(self._get_app, global_state["ms_graph.tenant_id"], global_state["ms_graph.client_id"])
+
+    def _acquire_silent(self, tenant_id, client_id, username, force_refresh):
+        app = self._get_app(tenant_id, client_id)
+        accounts = app.get_accounts(username=username) if username else app.get_accounts()
+        if not accounts:
+            return None
+
+        result = app.acquire_token_silent(SCOPES, account=accounts[0], force_refresh=force_refresh)
+        self._persist(tenant_id, client_id)
+        return result
+
+    async def get_token(self, global_state: dict, required: bool = True) -> str | None:
+        """Returns an access token for the thread's tenant/client/account without user interaction."""
+        if "ms_graph.tenant_id" not in global_state or "ms_graph.client_id" not in global_state:
+            if required:
+                raise Exception("Microsoft Graph is not set up. Call setup_ms_graph first.")
+            return None
+
+        tenant_id, client_id = global_state["ms_graph.tenant_id"], global_state["ms_graph.client_id"]
+        username = global_state.get("ms_graph.account") or global_state.get("ms_graph.email")
+        key = (tenant_id, client_id, username)
+
+        token = self.tokens.get(key)
+        if token and token["expires_at"] - time.time() > self.refresh_margin:
+            self.silent_hits += 1
+            return token["access_token"]
+
+        # msal only refreshes tokens that are about to expire within its own skew, force it once we are inside our margin
+        result = await asyncio.to_thread(self._acquire_silent, tenant_id, client_id, username, token is not None)
+        if result and "access_token" in result:
+            self.silent_acquisitions += 1
+            self.tokens[key] = {"access_token": result["access_token"], "expires_at": time.time() + result.get("expires_in", 0)}
+            return result["access_token"]
+
+        if required:
+            raise Exception("Microsoft Graph is not authenticated. Call authenticate_ms_graph first.")
+        return None
+
+    def remember(self, global_state: dict, token_response: dict):
+        """Keeps the result of an interactive sign-in, msal has already stored it in the token cache."""
+        tenant_id, client_id = global_state["ms_graph.tenant_id"], global_state["ms_graph.client_id"]
+        username = token_response.get("id_token_claims", {}).get("preferred_username") or global_state.get("ms_graph.email")
+        global_state["ms_graph.account"] = username
+
+        self.tokens[(tenant_id, client_id, username)] = {
+            "access_token": token_response["access_token"],
+            "expires_at": time.time() + token_response.get("expires_in", 0)
+        }
+        self._persist(tenant_id, client_id)
+
+    def stats(self):
+        return {
+            "clients": len(self.apps),
+            "tokens": len(self.tokens),
+            "silent_hits": self.silent_hits,
+            "silent_acquisitions": self.silent_acquisitions
+        }
+
+# Create a single instance to be used across the application
+ms_graph_auth = MSGraphAuth(
+    cache_dir=os.getenv("MSAL_TOKEN_CACHE_DIR", "./data/msal_cache"),
+    refresh_margin=int(os.getenv("MSAL_REFRESH_MARGIN", "300"))
+)
@@ -0,0 +1,354 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Literal
+from pydantic import BaseModel
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+BASELINE_DPI = 200
+
+class ImageBudget(BaseModel):
+    """How a page may be rendered for a vision payload: the renderer picks the DPI, colorspace, crop and
+    encoding per page so that each image fits max_pixels and, if possible, max_bytes."""
+    max_pixels: int = 1_500_000
+    max_bytes: int = 350_000
+    max_dpi: int = BASELINE_DPI
+    min_dpi: int = 72
+    formats: List[Literal["png", "jpeg", "webp"]] = ["jpeg", "png"]
+    quality: int = 75
+    grayscale: Literal["auto", "always", "never"] = "auto"
+    crop: bool = True
+    detail: Literal["auto", "low", "high"] = "auto"
+    # bytes_saved compares against the page as a 200 DPI PNG. By default that size is estimated from the
+    # rendered page, measure_baseline renders every page a second time to measure it exactly.
+    measure_baseline: bool = False
+
+    @property
+    def key(self):
+        return hashlib.sha1(self.model_dump_json().encode()).hexdigest()[:12]
+
+# Full pages as PNG at up to 200 DPI, for IMAGE_BUDGET_ENABLED=false
+FULL_PAGE_PNG = ImageBudget(
+    max_pixels=2**40, max_bytes=2**40, formats=["png"], grayscale="never", crop=False, detail="high", measure_baseline=False
+)
+
+def _content_clip(page, margin=12):
+    # union of everything that is drawn on the page, text, vector graphics and images
+    import fitz as pymupdf
+
+    clip = pymupdf.Rect()
+    for _, bbox in page.get_bboxlog():
+        clip |= pymupdf.Rect(bbox)
+    clip = (clip + (-margin, -margin, margin, margin)) & page.rect
+    return page.rect if clip.is_empty else clip
+
+def _encode(pix, image_format, quality):
+    if image_format == "png":
+        return pix.tobytes("png")
+    if image_format == "jpeg":
+        return pix.tobytes("jpeg", jpg_quality=quality)
+
+    # pymupdf cannot write WebP, PIL can
+    from PIL import Image
+    import io
+
+    img = Image.frombytes("L" if pix.n == 1 else "RGB", [pix.width, pix.height], pix.samples)
+    buffer = io.BytesIO()
+    img.save(buffer, format="WEBP", quality=quality)
+    return buffer.getvalue()
+
+def _render_pages(pdf_bytes, page_numbers, budget):
+    """Renders the given pages within the image budget, straight from the pixmap. Runs in the worker processes.
+
+    Returns (image bytes, info) per page."""
+    import fitz as pymupdf
+
+    budget = ImageBudget(**budget)
+    pages = []
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as pdf_document:
+        for page_num in page_numbers:
+            page = pdf_document.load_page(page_num)
+            clip = _content_clip(page) if budget.crop else page.rect
+            grayscale = budget.grayscale == "always" or (
+                budget.grayscale == "auto" and not any(kind.endswith("image") for kind, _ in page.get_bboxlog())
+            )
+
+            # largest zoom that stays within the pixel budget, then step down until the bytes fit as well
+            zoom = min(budget.max_dpi / 72, math.sqrt(budget.max_pixels / max(1, clip.width * clip.height)))
+            while True:
+                pix = page.get_pixmap(
+                    matrix=pymupdf.Matrix(zoom, zoom), clip=clip, alpha=False,
+                    colorspace=pymupdf.csGRAY if grayscale else pymupdf.csRGB
+                )
+                encoded = {image_format: _encode(pix, image_format, budget.quality) for image_format in budget.formats}
+                image_format = min(encoded, key=lambda image_format: len(encoded[image_format]))
+                data = encoded[image_format]
+                if len(data) <= budget.max_bytes or zoom * 0.75 < budget.min_dpi / 72:
+                    break
+                zoom *= 0.75
+
+            baseline_zoom = BASELINE_DPI / 72
+            if budget.measure_baseline:
+                baseline_bytes = len(page.get_pixmap(matrix=pymupdf.Matrix(baseline_zoom, baseline_zoom), alpha=False).tobytes("png"))
+            else:
+                # PNG bytes per pixel of this rendering, scaled to the whole page at the baseline DPI
+                png_bytes = len(encoded["png"]) if "png" in encoded else len(pix.tobytes("png"))
+                baseline_pixels = page.rect.width * page.rect.height * baseline_zoom ** 2
+                baseline_bytes = round(png_bytes * baseline_pixels / max(1, pix.width * pix.height))
+
+            if budget.detail == "auto":
+                detail = "low" if max(pix.width, pix.height) <= 512 else "high"
+            else:
+                detail = budget.detail
+
+            pages.append((data, {
+                "format": image_format,
+                "width": pix.width,
+                "height": pix.height,
+                "dpi": round(zoom * 72),
+                "grayscale": grayscale,
+                "cropped": clip != page.rect,
+                "detail": detail,
+                "bytes": len(data),
+                "baseline_bytes": baseline_bytes,
+                "baseline_measured": budget.measure_baseline
+            }))
+    return pages
+
+def _page_count(pdf_bytes):
+    import fitz as pymupdf
+
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as pdf_document:
+        return len(pdf_document)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class PageCache:
+    """Rendered pages keyed by (document hash, page, budget): an in-memory LRU in front of a directory on disk.
+
+    Both levels are bounded in bytes and evict the least recently used pages. The disk index is rebuilt
+    from the directory on first use, ordered by last access. get() and put() do file IO, call them off
+    the event loop."""
+
+    def __init__(self, directory, max_memory_bytes, max_disk_bytes):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+
+        self.entries = OrderedDict()
+        self.memory_bytes = 0
+        self.disk_entries = None  # key -> bytes on disk, least recently used first
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        doc_hash, page_num, budget_key = key
+        return os.path.join(self.directory, doc_hash[:2], f"{doc_hash}-{page_num}-{budget_key}")
+
+    def _load_disk_index(self):
+        # called with the lock held
+        if self.disk_entries is not None:
+            return
+        entries = []
+        if self.directory and os.path.isdir(self.directory):
+            for root, _, file_names in os.walk(self.directory):
+                for file_name in file_names:
+                    if not file_name.endswith(".json"):
+                        continue
+                    path = os.path.join(root, file_name[:-len(".json")])
+                    try:
+                        stat = os.stat(path)
+                        size = stat.st_size + os.path.getsize(f"{path}.json")
+                        doc_hash, page_num, budget_key = os.path.basename(path).rsplit("-", 2)
+                        entries.append((stat.st_atime, (doc_hash, int(page_num), budget_key), size))
+                    except (OSError, ValueError):
+                        continue
+        self.disk_entries = OrderedDict((key, size) for _, key, size in sorted(entries, key=lambda entry: entry[0]))
+        self.disk_bytes = sum(self.disk_entries.values())
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+            self._load_disk_index()
+            on_disk = key in self.disk_entries
+
+        if on_disk:
+            try:
+                with open(self._path(key), "rb") as f:
+                    data = f.read()
+                with open(f"{self._path(key)}.json") as f:
+                    info = json.load(f)
+                os.utime(self._path(key))
+            except (OSError, ValueError):
+                with self.lock:
+                    self.disk_bytes -= self.disk_entries.pop(key, 0)
+            else:
+                with self.lock:
+                    if key in self.disk_entries:
+                        self.disk_entries.move_to_end(key)
+                    self.hits += 1
+                self._remember(key, (data, info))
+                return data, info
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, page):
+        if self.directory:
+            data, info = page
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            # the info file is written last, get() only trusts pages that have one
+            with open(tmp_path, "w") as f:
+                json.dump(info, f)
+            os.replace(tmp_path, f"{path}.json")
+            size = len(data) + os.path.getsize(f"{path}.json")
+
+            with self.lock:
+                self._load_disk_index()
+                self.disk_bytes -= self.disk_entries.pop(key, 0)
+                self.disk_entries[key] = size
+                self.disk_bytes += size
+
+                evicted = []
+                while self.disk_bytes > self.max_disk_bytes and len(self.disk_entries) > 1:
+                    evicted_key, evicted_size = self.disk_entries.popitem(last=False)
+                    self.disk_bytes -= evicted_size
+                    evicted.append(evicted_key)
+
+            for evicted_key in evicted:
+                _remove(f"{self._path(evicted_key)}.json")
+                _remove(self._path(evicted_key))
+        self._remember(key, page)
+
+    def _remember(self, key, page):
+        with self.lock:
+            if key in self.entries:
+                self.memory_bytes -= len(self.entries.pop(key)[0])
+            self.entries[key] = page
+            self.memory_bytes += len(page[0])
+            while self.memory_bytes > self.max_memory_bytes and len(self.entries) > 1:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.memory_bytes -= len(evicted)
+
+class PdfRenderer:
+    """Rasterizes PDF pages in a process pool, serving repeated views of the same document from the page cache."""
+
+    def __init__(self, workers, cache: PageCache, budget: ImageBudget):
+        self.workers = workers
+        self.cache = cache
+        self.budget = budget
+        self.executor = None
+        self.executor_lock = threading.Lock()
+
+        self.bytes_sent = 0
+        self.bytes_saved = 0
+
+    def _get_executor(self):
+        # workers=0 renders on the default thread pool instead of worker processes
+        if self.workers <= 0:
+            return None
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self.executor
+
+    async def render(self, pdf_bytes, page_limit=10, budget: ImageBudget | None = None):
+        """Returns (image bytes, info) for each of the first page_limit pages, rendered within the budget."""
+        budget = budget or self.budget
+        doc_hash = hashlib.sha256(pdf_bytes).hexdigest()
+        loop = asyncio.get_running_loop()
+
+        page_count = await loop.run_in_executor(None, _page_count, pdf_bytes)
+        keys = [(doc_hash, page_num, budget.key) for page_num in range(min(page_count, page_limit))]
+        pages = await loop.run_in_executor(None, lambda: [self.cache.get(key) for key in keys])
+
+        missing = [page_num for page_num, page in enumerate(pages) if page is None]
+        if missing:
+            logger.debug(f"Rendering {len(missing)} of {len(keys)} pages of {doc_hash}")
+            # one chunk of pages per worker, each worker opens the document once
+            n_chunks = max(1, min(self.workers, len(missing)))
+            chunks = [missing[i::n_chunks] for i in range(n_chunks)]
+            executor = self._get_executor()
+            results = await asyncio.gather(*(
+                loop.run_in_executor(executor, _render_pages, pdf_bytes, chunk, budget.model_dump())
+                for chunk in chunks
+            ))
+            for chunk, chunk_pages in zip(chunks, results):
+                for page_num, page in zip(chunk, chunk_pages):
+                    pages[page_num] = page
+            await loop.run_in_executor(None, lambda: [self.cache.put(keys[page_num], pages[page_num]) for page_num in missing])
+
+        sent = sum(info["bytes"] for _, info in pages)
+        saved = sum(info["baseline_bytes"] - info["bytes"] for _, info in pages if info["baseline_bytes"] is not None)
+        self.bytes_sent += sent
+        self.bytes_saved += saved
+        logger.info(f"Rendered {len(pages)} pages of {doc_hash}: {sent} bytes, {saved} bytes saved")
+
+        return pages
+
+    def stats(self):
+        with self.cache.lock:
+            return {
+                "workers": self.workers,
+                "budget": self.budget.model_dump(),
+                "bytes_sent": self.bytes_sent,
+                "bytes_saved": self.bytes_saved,
+                "cache_hits": self.cache.hits,
+                "cache_misses": self.cache.misses,
+                "cache_entries": len(self.cache.entries),
+                "cache_memory_bytes": self.cache.memory_bytes,
+                "cache_disk_bytes": self.cache.disk_bytes,
+                "cache_max_disk_bytes": self.cache.max_disk_bytes
+            }
+
+    def shutdown(self):
+        with self.executor_lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+# Create a single instance to be used across the application
+pdf_renderer = PdfRenderer(
+    workers=int(os.getenv("PDF_RENDER_WORKERS", str(min(4, os.cpu_count() or 1)))),
+    cache=PageCache(
+        directory=os.getenv("PDF_RENDER_CACHE_DIR", "./data/render_cache"),
+        max_memory_bytes=int(os.getenv("PDF_RENDER_CACHE_MEMORY_MB", "128")) * 1024 * 1024,
+        max_disk_bytes=int(os.getenv("PDF_RENDER_CACHE_DISK_MB", "1024")) * 1024 * 1024
+    ),
+    budget=ImageBudget(
+        max_pixels=int(os.getenv("IMAGE_BUDGET_MAX_PIXELS", "1500000")),
+        max_bytes=int(os.getenv("IMAGE_BUDGET_MAX_BYTES", "350000")),
+        max_dpi=int(os.getenv("IMAGE_BUDGET_MAX_DPI", str(BASELINE_DPI))),
+        min_dpi=int(os.getenv("IMAGE_BUDGET_MIN_DPI", "72")),
+        formats=os.getenv("IMAGE_BUDGET_FORMATS", "jpeg,png").split(","),
+        quality=int(os.getenv("IMAGE_BUDGET_QUALITY", "75")),
+        grayscale=os.getenv("IMAGE_BUDGET_GRAYSCALE", "auto"),
+        crop=os.getenv("IMAGE_BUDGET_CROP", "true").lower() == "true",
+        detail=os.getenv("IMAGE_BUDGET_DETAIL", "auto"),
+        measure_baseline=os.getenv("IMAGE_BUDGET_MEASURE_BASELINE", "false").lower() == "true"
+    ) if os.getenv("IMAGE_BUDGET_ENABLED", "true").lower() == "true" else FULL_PAGE_PNG
+)
@@ -1,6 +1,10 @@
-from fastapi import APIRouter, Depends, HTTPException, WebSocket, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect, BackgroundTasks, Request, Response
+from fastapi.responses import FileResponse
+from sqlalchemy import func
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
+import base64
+import hashlib
 import logging
 import asyncio
 import json
@@ -11,6 +15,7 @@ from ..models import Thread, Message
 from ..schemas import ThreadCreate, Thread as ThreadSchema
 from ..tools import *
 from ..connections import manager
+from ..blobs import blob_store, blob_url, sniff_mime_type
 from .agent_new import Agent, Event, EventTypes
 
 # Configure logging
@@ -20,6 +25,10 @@ router = APIRouter()
 
 agents = {}
 
+MESSAGE_FIELDS = list(Message.__table__.columns.keys())
+# api_messages duplicates the content for the model and is never needed by the UI
+DEFAULT_MESSAGE_FIELDS = [field for field in MESSAGE_FIELDS if field != "api_messages"]
+
 @router.post("/api/threads/create", response_model=ThreadSchema)
 async def create_thread(thread: ThreadCreate, db: Session = Depends(get_db)):
     try:
@@ -66,6 +75,108 @@ async def get_thread_messages(thread_id: int, db: Session = Depends(get_db)):
         logger.error(f"Error fetching messages for thread {thread_id}: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
     
+@router.get("/api/threads/{thread_id}/messages")
+async def list_thread_messages(
+    thread_id: int,
+    request: Request,
+    response: Response,
+    after_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    latest: bool = False,
+    limit: int = 100,
+    fields: Optional[str] = None,
+    include_images: bool = False,
+    db: Session = Depends(get_db)
+):
+    """Cursor paginated thread history. Pass next_cursor as after_id to get the following page.
+
+    With latest=true (or a before_id) the page is the newest limit messages instead, still in
+    conversation order; pass prev_cursor as before_id to get the page before it. Image messages come
+    without their content unless include_images is set, see get_message_images."""
+    try:
+        logger.info(f"Fetching messages for thread ID: {thread_id} after message {after_id} before message {before_id}")
+        
+        if not db.query(Thread.id).filter(Thread.id == thread_id).first():
+            logger.error(f"Thread with ID {thread_id} not found")
+            raise HTTPException(status_code=404, detail="Thread not found")
+        
+        selected_fields = fields.split(",") if fields else DEFAULT_MESSAGE_FIELDS
+        unknown_fields = set(selected_fields) - set(MESSAGE_FIELDS)
+        if unknown_fields:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown_fields))}")
+        limit = max(1, min(limit, 500))
+        
+        latest = latest or before_id is not None
+        query = db.query(Message).filter(Message.thread_id == thread_id)
+        if after_id is not None:
+            query = query.filter(Message.id > after_id)
+        if before_id is not None:
+            query = query.filter(Message.id < before_id)
+        
+        # Any insert or update in the range changes count, max id or the version sum
+        count, max_id, version_sum = query.with_entities(func.count(Message.id), func.max(Message.id), func.sum(Message.version)).one()
+        etag_source = f"{thread_id}:{after_id}:{before_id}:{latest}:{limit}:{','.join(selected_fields)}:{include_images}:{count}:{max_id}:{version_sum}"
+        etag = f'W/"{hashlib.sha1(etag_source.encode()).hexdigest()}"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        
+        columns = [getattr(Message, field) for field in dict.fromkeys(["id", "content_type"] + selected_fields)]
+        if latest:
+            rows = query.with_entities(*columns).order_by(Message.id.desc()).limit(limit).all()[::-1]
+        else:
+            rows = query.with_entities(*columns).order_by(Message.id).limit(limit).all()
+        
+        messages = []
+        for row in rows:
+            message = dict(row._mapping)
+            if not include_images and message["content_type"] == "image_url_list":
+                message["content"] = None
+            messages.append({field: message[field] for field in selected_fields})
+        
+        response.headers.update(headers)
+        next_cursor = rows[-1].id if len(rows) == limit and not latest else None
+        prev_cursor = rows[0].id if len(rows) == limit and latest else None
+        logger.info(f"Successfully fetched {len(messages)} messages for thread {thread_id}")
+        return {"messages": messages, "next_cursor": next_cursor, "prev_cursor": prev_cursor}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error fetching messages for thread {thread_id}: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+    
+@router.get("/api/threads/{thread_id}/messages/{message_id}/images")
+async def get_message_images(thread_id: int, message_id: int, db: Session = Depends(get_db)):
+    """The image URLs of an image message, which the history pages leave out by default.
+
+    Rows written before the blob store hold data URLs; their images are moved into the blob store on
+    the first request, so only /api/blobs/<hash> URLs are sent to the UI."""
+    try:
+        message = db.query(Message).filter(Message.id == message_id, Message.thread_id == thread_id).first()
+        if not message or message.content_type != "image_url_list":
+            raise HTTPException(status_code=404, detail="Image message not found")
+        
+        urls = json.loads(message.content or "[]")
+        if any(url.startswith("data:") for url in urls):
+            logger.info(f"Moving the inline images of message {message_id} to the blob store")
+            urls = await asyncio.to_thread(_store_data_urls, urls)
+            message.content = json.dumps(urls)
+            db.commit()
+        
+        return {"urls": urls}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error fetching images of message {message_id} for thread {thread_id}: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+def _store_data_urls(urls):
+    return [
+        blob_url(blob_store.put(base64.b64decode(url.split(",", 1)[1]))) if url.startswith("data:") else url
+        for url in urls
+    ]
+    
 @router.get("/api/threads/{thread_id}/get_thread_message/{message_id}")
 async def get_thread_message(thread_id: int, message_id: int, db: Session = Depends(get_db)):
     try:
@@ -82,6 +193,25 @@ async def get_thread_message(thread_id: int, message_id: int, db: Session = Depe
         logger.error(f"Error fetching message with ID {message_id} for thread {thread_id}: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/api/blobs/{blob_hash}")
+async def get_blob(blob_hash: str, request: Request):
+    try:
+        path = blob_store.path(blob_hash)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid blob hash")
+    
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Blob not found")
+    
+    # Blobs are immutable, the hash is a strong validator
+    headers = {"ETag": f'"{blob_hash}"', "Cache-Control": "public, max-age=31536000, immutable"}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    
+    with open(path, "rb") as f:
+        media_type = sniff_mime_type(f.read(12))
+    return FileResponse(path, media_type=media_type, headers=headers)
+
 @router.websocket("/ws/{thread_id}")
 async def websocket_endpoint(websocket: WebSocket, thread_id: int):
     try:
@@ -129,3 +259,18 @@ async def send_message(
     except Exception as e:
         logger.error(f"Error sending message to thread {thread_id}: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/api/threads/{thread_id}/interrupt")
+async def interrupt_thread(thread_id: int):
+    try:
+        logger.info(f"Interrupting thread ID: {thread_id}")
+        
+        if thread_id not in agents:
+            return {"status": "idle"}
+        
+        agents[thread_id].handle_event(Event(type=EventTypes.INTERRUPT, data=None))
+        
+        return {"status": "success"}
+    except Exception as e:
+        logger.error(f"Error interrupting thread {thread_id}: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
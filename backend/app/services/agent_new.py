@@ -15,18 +15,37 @@ root_logger.debug("Agent module initialized")
 
 import os
 import time
+import base64
 import asyncio
 from enum import Enum
 from pydantic import BaseModel
 import json
 
 from pyee import EventEmitter
-from openai import OpenAI
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletion
 
 from ..tools import *
 from sqlalchemy.orm import Session
 from ..models import Message, Thread
 from .. import database as db
+from ..blobs import blob_store, blob_ref, blob_url
+from ..connections import manager
+from .conversation import ConversationCache, order_tool_results
+from .context import ContextWindow, count_tokens, CONTEXT_BUDGET_TOKENS, CONTEXT_TARGET_TOKENS, CONTEXT_KEEP_RECENT_TURNS, CONTEXT_TOOL_RESULT_CHARS
+from .progress import ProgressChannel
+from .prompt_cache import prompt_cache_stats
+
+_openai_client = None
+
+def openai_client() -> AsyncOpenAI:
+    # shared by all agents, creating a client sets up a new connection pool and TLS context
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    return _openai_client
+
+SYSTEM_PROMPT = "Your task is to use the available tools to solve the any given tasks. If you respond to the user, always respond in markdown format without indicating that it is markdown."
 
 class AgentState(Enum):
     AWAIT_INPUT = 'await_input'
@@ -58,98 +77,171 @@ class Agent:
         # self.emitter.on(thread_id, self.handle_event)
         
         self.timeout = 60.0 # seconds
-        self.client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        self.client = openai_client()
         self.model = "gpt-4o-mini"
         # self.model = "gpt-4o"
+        # Stream completions and push content deltas to the thread's websockets as they arrive
+        self.stream_completions = os.getenv("AGENT_STREAM_COMPLETIONS", "false").lower() == "true"
         self.notifications = []
-        self.current_task = None
-        
-        self.tool_box = ToolBox(self.thread_id)
-        self.tool_box.add_tool(SetupMSGraph())
-        self.tool_box.add_tool(AuthenticateMSGraph())
-        self.tool_box.add_tool(GetLatestEmail())
-        self.tool_box.add_tool(ListEmails())
-        self.tool_box.add_tool(ViewPdfAttachment())
-        self.tool_box.add_tool(ViewPdfFile())
-        self.tool_box.add_tool(SaveEmailAttachment())
-        self.tool_box.add_tool(BexioListAccounts())
-        self.tool_box.add_tool(BexioGetContacts())
-        self.tool_box.add_tool(BexioCreateContact())
-        # self.tool_box.add_tool(BexioCreateInvoicePayable())
-        # self.tool_box.add_tool(BexioUploadEmailAttachment())
-        self.tool_box.add_tool(BexioUploadFile())
-        self.tool_box.add_tool(BexioCreateInvoicePayable())
-        
-        self.tools_schema = []
-        for tool in self.tool_box.get_tools():
-            schema = self._to_function_schema(tool)
-            self.tools_schema.append(schema)
-        
-        self._add_message(AgentState.AWAIT_INPUT, "developer", "Your task is to use the available tools to solve the any given tasks. If you respond to the user, always respond in markdown format without indicating that it is markdown.")
+        self.tasks = set() # running completions and tool calls, cancelled on interrupt
+        
+        # With parallel tool calls, all calls of an assistant message run concurrently (up to the cap)
+        # and the next completion is submitted once every one of them is finalized
+        self.parallel_tool_calls = os.getenv("AGENT_PARALLEL_TOOL_CALLS", "false").lower() == "true"
+        self.max_concurrent_tool_calls = int(os.getenv("AGENT_MAX_CONCURRENT_TOOL_CALLS", "4")) if self.parallel_tool_calls else 1
+        self.tool_call_semaphore = asyncio.Semaphore(self.max_concurrent_tool_calls)
+        self.pending_tool_calls = set()
+        
+        # Tool progress updates are coalesced and written at most once per window
+        self.progress_window = float(os.getenv("AGENT_PROGRESS_WINDOW_MS", "250")) / 1000
+        self.progress_channels = {}
+        self.conversation = ConversationCache(self.thread_id)
+        # Old images and tool results are compacted once the history outgrows the token budget
+        self.context_window = ContextWindow(
+            self.thread_id,
+            budget=CONTEXT_BUDGET_TOKENS,
+            target=CONTEXT_TARGET_TOKENS,
+            keep_recent_turns=CONTEXT_KEEP_RECENT_TURNS,
+            tool_result_chars=CONTEXT_TOOL_RESULT_CHARS
+        )
+        
+        # tool instances and schemas are built once per process, the toolbox state is loaded on the first call
+        self.tool_box = ToolBox(self.thread_id, tool_registry.tools())
+        self.tools_schema = tool_registry.schemas()
+        
+        self._add_message(AgentState.AWAIT_INPUT, "developer", SYSTEM_PROMPT)
         
     
-    @staticmethod
-    def _to_function_schema(tool):    
-        return {
-        "type": "function",
-        "function": {
-            "name": tool.tool_name,
-            "description": tool.tool_description,
-            "parameters": {
-                "type": "object",
-                "properties": tool.args_model.schema()["properties"]},
-                "required": list(tool.args_model.schema()["properties"].keys()),
-                "additionalProperties": False
-            },
-            "strict": True
-        }
+    async def _build_request(self):
+        # The provider caches prompts by prefix: tools first, then the system prompt, then the history.
+        # Everything here is deterministic for the same history, so each turn only appends to the prefix.
+        messages = await self._get_api_messages()
+        # agents created for an existing thread (e.g. after a restart) append the system prompt again
+        system_prompt = {"role": "developer", "content": SYSTEM_PROMPT}
+        messages = messages[:1] + [api_message for api_message in messages[1:] if api_message != system_prompt]
+        return dict(
+            model=self.model,
+            messages=messages,
+            tools=self.tools_schema,
+            tool_choice="auto",
+            parallel_tool_calls=self.parallel_tool_calls,
+            temperature=0.0,
+            max_tokens=5000
+        )
     
     def _submit_completion(self):
         self.logger.debug("Submitting completion request")
-        def run_completion():
-            completion = self.client.chat.completions.create(
-                model=self.model,
-                messages=self._get_api_messages(),
-                tools=self.tools_schema,
-                tool_choice="auto",
-                parallel_tool_calls=False,
-                temperature=0.0,
-                max_tokens=5000
-            )
+        async def run_completion():
+            request = await self._build_request()
+            start = time.monotonic()
+            if self.stream_completions:
+                completion = await self._stream_completion(request)
+            else:
+                completion = await self.client.chat.completions.create(**request)
+            prompt_cache_stats.record(self.thread_id, completion.usage, time.monotonic() - start)
             self.logger.debug(completion.choices[0].message)
             return completion
         
-        self.exec_and_callback(run_completion, EventTypes.AI_RESULT)
+        self.exec_and_callback(run_completion, EventTypes.AI_RESULT, timeout=self.timeout)
+    
+    async def _stream_completion(self, request):
+        # Accumulates the streamed chunks into a regular ChatCompletion, which is persisted once by the AI_RESULT handler
+        # the usage (with the cached prompt tokens) arrives in a last chunk without choices
+        stream = await self.client.chat.completions.create(**request, stream=True, stream_options={"include_usage": True})
+        
+        completion_id = None
+        created = 0
+        content_parts = []
+        tool_calls = {}
+        finish_reason = None
+        usage = None
+        
+        async for chunk in stream:
+            completion_id, created = chunk.id, chunk.created
+            if chunk.usage:
+                usage = chunk.usage.model_dump()
+            if not chunk.choices:
+                continue
+            
+            choice = chunk.choices[0]
+            delta = choice.delta
+            
+            if delta.content:
+                content_parts.append(delta.content)
+                await manager.broadcast_to_thread(self.thread_id, {
+                    "event_type": "message_delta",
+                    "thread_id": self.thread_id,
+                    "completion_id": completion_id,
+                    "delta": delta.content
+                })
+            
+            for tool_call_delta in delta.tool_calls or []:
+                tool_call = tool_calls.setdefault(tool_call_delta.index, {"id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+                if tool_call_delta.id:
+                    tool_call["id"] = tool_call_delta.id
+                if tool_call_delta.function:
+                    tool_call["function"]["name"] += tool_call_delta.function.name or ""
+                    tool_call["function"]["arguments"] += tool_call_delta.function.arguments or ""
+            
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+        
+        return ChatCompletion.model_validate({
+            "id": completion_id or "",
+            "object": "chat.completion",
+            "created": created,
+            "model": self.model,
+            "choices": [{
+                "index": 0,
+                "finish_reason": finish_reason,
+                "message": {
+                    "role": "assistant",
+                    "content": "".join(content_parts) if content_parts else None,
+                    "tool_calls": [tool_calls[index] for index in sorted(tool_calls)] or None
+                }
+            }],
+            "usage": usage
+        })
     
     def _add_message(self, agent_state, role, content):
         self.logger.debug(f"Adding {role} message: {content}")
     
+        api_messages = [{"role": role, "content": content}]
         with db.SessionLocal() as session:
             db_message = Message(
                 thread_id=self.thread_id,
-                api_messages=json.dumps([{"role": role, "content": content}]),
+                api_messages=json.dumps(api_messages),
                 agent_state=agent_state.value,
                 role=role,
                 content=content
             )
             session.add(db_message)
-            session.commit()
+            self._commit_message(session, db_message, api_messages)
         
         self.emitter.emit(self.thread_id, {"status": "update"})
     
+    def _commit_message(self, session, db_message, api_messages):
+        # flush first so the id and version are known without reloading the row after the commit
+        db_message.token_count = count_tokens(api_messages)
+        session.flush()
+        message_id, version = db_message.id, db_message.version
+        session.commit()
+        self.conversation.put(message_id, version, api_messages, db_message.token_count)
+    
     def _add_user_message(self, msg):
         self.logger.debug(f"Adding user message: {msg}")
               
+        api_messages = [{"role": "user", "content": msg}]
         with db.SessionLocal() as session:
             db_message = Message(
                 thread_id=self.thread_id,
-                api_messages=json.dumps([{"role": "user", "content": msg}]),
+                api_messages=json.dumps(api_messages),
                 agent_state=AgentState.AWAIT_AI_RESPONSE.value,
                 role="user",
                 content=msg
             )
             session.add(db_message)
-            session.commit()
+            self._commit_message(session, db_message, api_messages)
         
         self.emitter.emit(self.thread_id, {"status": "update"})
     
@@ -163,16 +255,17 @@ class Agent:
         else:
             raise Exception(f"Invalid finish reason: {finish_reason}")
         
+        api_messages = [msg.dict()]
         with db.SessionLocal() as session:
             db_message = Message(
                 thread_id=self.thread_id,
-                api_messages=json.dumps([msg.dict()]),
+                api_messages=json.dumps(api_messages),
                 agent_state=agent_state.value,
                 role=msg.role,
                 content=msg.content
             )
             session.add(db_message)
-            session.commit()
+            self._commit_message(session, db_message, api_messages)
         
         self.emitter.emit(self.thread_id, {"status": "update"})
     
@@ -181,7 +274,7 @@ class Agent:
         api_message = {
             "role": "tool", 
             "tool_call_id": tool_call_id, 
-            "content": json.dumps({"error" : "Tool call was cancelled."})
+            "content": canonical_json({"error" : "Tool call was cancelled."})
         }
         with db.SessionLocal() as session:
             db_message = Message(
@@ -195,7 +288,7 @@ class Agent:
                 tool_state="running"
             )
             session.add(db_message)
-            session.commit()
+            self._commit_message(session, db_message, [api_message])
             
         self.emitter.emit(self.thread_id, {"status": "update"})
     
@@ -206,6 +299,10 @@ class Agent:
             db_message = session.query(Message).filter(Message.tool_call_id == tool_call_id).first()
             if not db_message:
                 raise Exception(f"Tool call message not found for tool_call_id: {tool_call_id}")
+            if db_message.tool_state != ToolCallState.RUNNING.value:
+                # finalized or interrupted in the meantime, progress must not bring the row back to running
+                self.logger.debug(f"Ignoring progress of tool call {tool_call_id} in state {db_message.tool_state}")
+                return
             
             # Update existing message
             db_message.content = tool_call_result.display_data
@@ -213,11 +310,14 @@ class Agent:
             db_message.tool_state = tool_call_result.state.value
             db_message.tool_display_data = tool_call_result.display_data
             
+            session.flush()
+            message_id, version = db_message.id, db_message.version
             session.commit()
+            self.conversation.touch(message_id, version)
         
         self.emitter.emit(self.thread_id, {"status": "update"})
         
-    def __finalize_tool_call_message(self, tool_call_id, tool_call_result):
+    def __finalize_tool_call_message(self, tool_call_id, tool_call_result, agent_state=AgentState.AWAIT_AI_RESPONSE):
         self.logger.debug(f"Finalizing tool call message for tool_call_id: {tool_call_id}")
         
         with db.SessionLocal() as session:
@@ -228,64 +328,133 @@ class Agent:
             api_messages = []
         
             if tool_call_result.result_type == "text":
-                content = json.dumps(tool_call_result.result)
-                api_messages.append({"role": "tool", "tool_call_id": tool_call_id, "content": json.dumps(tool_call_result.result)})
+                # the row keeps the full result, the model gets the part the tool's result policy allows
+                content = canonical_json(tool_call_result.result)
+                projected = project_result(tool_call_result.result, self.tool_box.result_policy(db_message.tool_name), tool_call_id)
+                api_messages.append({"role": "tool", "tool_call_id": tool_call_id, "content": canonical_json(projected)})
                 db_message.tool_result = content
                 db_message.content = tool_call_result.display_data
                 db_message.content_type = "text"
                 
-            elif tool_call_result.result_type == "base64_png_list":
-                api_messages.append({"role": "tool", "tool_call_id": tool_call_id, "content": f"{len(tool_call_result.result)} images will be included in the next message"})
+            elif tool_call_result.result_type in ("base64_png_list", "image_list"):
+                # The images go to the blob store, the row only keeps references to them. Results of tool
+                # calls were stored off the loop by _store_result_images already.
+                blob_hashes = (tool_call_result.metadata or {}).get("blob_hashes")
+                if blob_hashes is None:
+                    blob_hashes = self._store_result_images(tool_call_result).metadata["blob_hashes"]
+                if tool_call_result.result_type == "base64_png_list":
+                    image_infos = [{} for _ in blob_hashes]
+                else:
+                    image_infos = (tool_call_result.metadata or {}).get("images") or [{} for _ in blob_hashes]
+                
+                api_messages.append({"role": "tool", "tool_call_id": tool_call_id, "content": f"{len(blob_hashes)} images will be included in the next message"})
                 api_messages.append({
                     "role": "user", 
                     "content": [{
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/png;base64,{base64_image}",
-                            "detail": "high"
+                            "url": blob_ref(blob_hash),
+                            "detail": image_info.get("detail", "high")
                         }
-                    } for base64_image in tool_call_result.result]
+                    } for blob_hash, image_info in zip(blob_hashes, image_infos)]
                 })
                 
-                db_message.tool_result = f"{len(tool_call_result.result)} images"
+                db_message.tool_result = f"{len(blob_hashes)} images"
+                if all(image_info.get("baseline_bytes") is not None for image_info in image_infos):
+                    sent = sum(image_info["bytes"] for image_info in image_infos)
+                    saved = sum(image_info["baseline_bytes"] - image_info["bytes"] for image_info in image_infos)
+                    estimated = not all(image_info.get("baseline_measured") for image_info in image_infos)
+                    db_message.tool_result += f", {sent} bytes ({'about ' if estimated else ''}{saved} bytes saved)"
                 db_message.content_type = "image_url_list"
-                db_message.content = json.dumps([f"data:image/png;base64,{base64_image}" for base64_image in tool_call_result.result])
+                db_message.content = json.dumps([blob_url(blob_hash) for blob_hash in blob_hashes])
                 
             else:
                 raise Exception(f"Invalid result type: {tool_call_result.result_type}")
         
             db_message.api_messages = json.dumps(api_messages)
-            db_message.agent_state = AgentState.AWAIT_AI_RESPONSE.value
+            db_message.agent_state = agent_state.value
             db_message.tool_state = tool_call_result.state.value            
             
-            session.commit()
+            self._commit_message(session, db_message, api_messages)
         
         self.emitter.emit(self.thread_id, {"status": "update"})
     
-    def _get_messages(self):
-        with db.SessionLocal() as session:
-            return session.query(Message).filter(Message.thread_id == self.thread_id).order_by(Message.created_at).all()
-            
+    @staticmethod
+    def _store_result_images(tool_call_result):
+        if tool_call_result.result_type == "base64_png_list":
+            images = [base64.b64decode(base64_image) for base64_image in tool_call_result.result]
+        else:
+            images = tool_call_result.result
+        metadata = {**(tool_call_result.metadata or {}), "blob_hashes": [blob_store.put(image) for image in images]}
+        return tool_call_result.model_copy(update={"metadata": metadata})
+    
     def _get_latest_agent_state(self):
-        messages = self._get_messages()
-        return AgentState(messages[-1].agent_state)
+        with db.SessionLocal() as session:
+            agent_state = session.query(Message.agent_state) \
+                .filter(Message.thread_id == self.thread_id) \
+                .order_by(Message.created_at.desc(), Message.id.desc()) \
+                .limit(1) \
+                .scalar()
+        return AgentState(agent_state)
     
-    def _get_api_messages(self):
+    async def _get_api_messages(self):
         with db.SessionLocal() as session:
-            db_message_list = session.query(Message).filter(Message.thread_id == self.thread_id).order_by(Message.created_at).all()
-            messages = []
-            for msg in db_message_list:
-                api_messages = json.loads(msg.api_messages)
-                if isinstance(api_messages, list):
-                    messages.extend(api_messages)
-                else:
-                    messages.append(api_messages)
-            return messages
+            entries = self.conversation.get_entries(session)
+        # compacted before the blobs are resolved, images left out of the context are never loaded
+        api_messages, report = self.context_window.build(entries)
+        self.logger.debug(f"Context: {report['sent_tokens']} of {report['history_tokens']} tokens ({report['saved_tokens']} saved)")
+        # the blobs are read off the loop
+        return await asyncio.to_thread(blob_store.resolve_api_messages, order_tool_results(api_messages))
+    
+    def _cancel_tasks(self):
+        self.logger.debug(f"Cancelling {len(self.tasks)} running tasks")
+        for task in list(self.tasks):
+            task.cancel()
     
-    def _cancel_current_task(self):
-        if self.current_task is not None:
-            self.current_task.cancel()
+    def _mark_interrupted(self):
+        # Running tool calls keep their "cancelled" api message and the thread goes back to awaiting input
+        updated = []
+        with db.SessionLocal() as session:
+            running_messages = session.query(Message).filter(
+                Message.thread_id == self.thread_id,
+                Message.tool_state == ToolCallState.RUNNING.value
+            ).all()
+            for db_message in running_messages:
+                db_message.tool_state = ToolCallState.ERROR.value
+                updated.append(db_message)
+            
+            session.flush()
+            versions = [(db_message.id, db_message.version) for db_message in updated]
+            session.commit()
         
+        for message_id, version in versions:
+            self.conversation.touch(message_id, version)
+        
+        self.pending_tool_calls.clear()
+        for tool_call_id in list(self.progress_channels):
+            self._close_progress_channel(tool_call_id)
+        self._set_latest_agent_state(AgentState.AWAIT_INPUT)
+    
+    def _close_progress_channel(self, tool_call_id):
+        progress_channel = self.progress_channels.pop(tool_call_id, None)
+        if progress_channel is not None:
+            progress_channel.close()
+            self.logger.debug(f"Tool call {tool_call_id} reported {progress_channel.updates} progress updates, {progress_channel.flushes} written")
+    
+    def _set_latest_agent_state(self, agent_state):
+        with db.SessionLocal() as session:
+            latest_message = session.query(Message).filter(Message.thread_id == self.thread_id).order_by(Message.created_at.desc(), Message.id.desc()).first()
+            if latest_message is None or latest_message.agent_state == agent_state.value:
+                return
+            
+            latest_message.agent_state = agent_state.value
+            session.flush()
+            message_id, version = latest_message.id, latest_message.version
+            session.commit()
+        
+        self.conversation.touch(message_id, version)
+        self.emitter.emit(self.thread_id, {"status": "update"})
+    
     def handle_event(self, event: Event):
         agent_state = self._get_latest_agent_state()
         self.logger.debug(f"Handling event: {event.type} in state: {agent_state}")
@@ -319,7 +488,8 @@ class Agent:
             case AgentState.AWAIT_AI_RESPONSE:
                 if event.type == EventTypes.INTERRUPT:
                     self.logger.info("Processing interrupt during AI response")
-                    self._cancel_current_task()
+                    self._cancel_tasks()
+                    self._mark_interrupted()
                     self._enter_await_input()
                     
                 elif event.type == EventTypes.NOTIFICATION:
@@ -340,21 +510,16 @@ class Agent:
                     elif completion.choices[0].finish_reason == "tool_calls":
                         self.logger.debug("AI completion finished with 'tool_calls'")
                         self._add_assistant_message(completion.choices[0].message, completion.choices[0].finish_reason)
-                        for tool_call in completion.choices[0].message.tool_calls:
-                            name = tool_call.function.name
-                            args = tool_call.function.arguments
-                            self.logger.info(f"Calling tool: {name}({args})")
-                            
-                            self._add_tool_result_message(tool_call.id, name, args)
-                            
-                            def on_update(tool_call_result: ToolCallResult): 
-                                self.__update_tool_call_message(tool_call.id, tool_call_result)
-
-                            async def tool_execution():
-                                return tool_call.id, await self.tool_box.call(name, args, on_update)
-
-                            self.exec_and_callback(tool_execution, EventTypes.TOOL_RESULT)
-                            self._enter_await_tool_response()
+                        tool_calls = completion.choices[0].message.tool_calls
+                        
+                        # All placeholders are written before any call runs so the latest message stays a tool message
+                        for tool_call in tool_calls:
+                            self._add_tool_result_message(tool_call.id, tool_call.function.name, tool_call.function.arguments)
+                        
+                        self.pending_tool_calls = {tool_call.id for tool_call in tool_calls}
+                        for tool_call in tool_calls:
+                            self._dispatch_tool_call(tool_call.id, tool_call.function.name, tool_call.function.arguments)
+                        self._enter_await_tool_response()
                     else:
                         self.logger.error(f"Invalid finish reason {completion.choices[0].finish_reason}")
                         raise Exception(f"Invalid finish reason {completion.choices[0].finish_reason}")
@@ -366,16 +531,26 @@ class Agent:
             case AgentState.AWAIT_TOOL_RESPONSE:
                 if event.type == EventTypes.INTERRUPT:
                     self.logger.info("Processing interrupt during tool response")
-                    self._cancel_current_task()
+                    self._cancel_tasks()
+                    self._mark_interrupted()
                     self._enter_await_input()
                     
                 elif event.type == EventTypes.TOOL_RESULT:
                     tool_call_id, tool_call_result = event.data
                     self.logger.info(f"Processing tool result for tool_call_id: {tool_call_id}")
-                    self.__finalize_tool_call_message(tool_call_id, tool_call_result)
+                    self.pending_tool_calls.discard(tool_call_id)
+                    self._close_progress_channel(tool_call_id)
                     
-                    self._submit_completion()
-                    self._enter_await_ai_response()
+                    if self.pending_tool_calls:
+                        self.logger.debug(f"Waiting for {len(self.pending_tool_calls)} more tool results")
+                        self.__finalize_tool_call_message(tool_call_id, tool_call_result, AgentState.AWAIT_TOOL_RESPONSE)
+                    else:
+                        self.__finalize_tool_call_message(tool_call_id, tool_call_result, AgentState.AWAIT_AI_RESPONSE)
+                        # the last finished call is not necessarily the last placeholder row
+                        self._set_latest_agent_state(AgentState.AWAIT_AI_RESPONSE)
+                        
+                        self._submit_completion()
+                        self._enter_await_ai_response()
                     
                 elif event.type == EventTypes.NOTIFICATION:
                     self.notifications.append(event.data)
@@ -386,38 +561,66 @@ class Agent:
         return True
                 
     
-    def exec_and_callback(self, f, event_type: EventTypes):
+    def _dispatch_tool_call(self, tool_call_id, name, args):
+        self.logger.info(f"Calling tool: {name}({args})")
+        
+        progress_channel = ProgressChannel(lambda tool_call_result: self.__update_tool_call_message(tool_call_id, tool_call_result), self.progress_window)
+        self.progress_channels[tool_call_id] = progress_channel
+        
+        def on_update(tool_call_result: ToolCallResult): 
+            progress_channel.update(tool_call_result)
+
+        def on_error(error):
+            return tool_call_id, ToolCallResult(result={"error": error}, state=ToolCallState.ERROR)
+
+        # tools that wait for the user (e.g. the device code sign-in) set their own timeout, None for no limit
+        timeout = getattr(self.tool_box.tools.get(name), "timeout", self.timeout)
+
+        async def tool_execution():
+            # the timeout starts once the call has a slot, waiting for one does not count against it
+            async with self.tool_call_semaphore:
+                try:
+                    tool_call_result = await asyncio.wait_for(self.tool_box.call(name, args, on_update), timeout=timeout)
+                except asyncio.TimeoutError:
+                    self.logger.error(f"Tool {name} timed out after {timeout} seconds")
+                    return on_error(f"Task timed out after {timeout} seconds")
+            
+            if tool_call_result.state == ToolCallState.COMPLETED and tool_call_result.result_type in ("base64_png_list", "image_list"):
+                # written to the blob store here, so that finalizing the message does no file IO on the loop
+                tool_call_result = await asyncio.to_thread(self._store_result_images, tool_call_result)
+            return tool_call_id, tool_call_result
+        
+        self.exec_and_callback(tool_execution, EventTypes.TOOL_RESULT, on_error)
+    
+    def exec_and_callback(self, f, event_type: EventTypes, on_error=None, timeout: float | None = None):
         self.logger.debug(f"Setting up execution for event type: {event_type}")
+        if on_error is None:
+            on_error = lambda error: {"error": error}
+        
         async def wrapper():
             try:
                 self.logger.debug("Starting task execution")
                 
-                # Create new event loop for the thread
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                
-                # Run the async function in the new thread
-                if asyncio.iscoroutinefunction(f):
-                    result = await asyncio.wait_for(f(), timeout=self.timeout)
-                else:
-                    result = await asyncio.wait_for(asyncio.to_thread(f), timeout=self.timeout)
+                result = await asyncio.wait_for(f(), timeout=timeout)
                 
                 event = Event(type=event_type, data=result)
                 self.handle_event(event)
                 
-                loop.close()
-                
+            except asyncio.CancelledError:
+                self.logger.info(f"Task for event type {event_type} was cancelled")
+                raise
             except asyncio.TimeoutError:
-                self.logger.error(f"Task timed out after {self.timeout} seconds")
-                event = Event(type=event_type, data={"error": f"Task timed out after {self.timeout} seconds"})
+                self.logger.error(f"Task timed out after {timeout} seconds")
+                event = Event(type=event_type, data=on_error(f"Task timed out after {timeout} seconds"))
                 self.handle_event(event)
             except Exception as e:
                 self.logger.error(f"Error in task execution: {e}", exc_info=True)
-                event = Event(type=event_type, data={"error": str(e)})
+                event = Event(type=event_type, data=on_error(str(e)))
                 self.handle_event(event)
 
-        # Run wrapper in new thread
-        self.current_task = asyncio.create_task(asyncio.to_thread(lambda: asyncio.run(wrapper())))
+        task = asyncio.get_running_loop().create_task(wrapper())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
     
     def _enter_await_input(self):
         self.logger.debug("Entering AWAIT_INPUT state")
@@ -0,0 +1,195 @@
+import importlib.util
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Rough per-image cost of the vision models: low detail is a flat 85 tokens, high detail is
+# 85 + 170 per 512px tile, which for the rendered PDF pages is typically 4 tiles.
+IMAGE_TOKENS = {"low": 85, "high": 765, "auto": 765}
+MESSAGE_OVERHEAD_TOKENS = 4
+
+if importlib.util.find_spec("tiktoken") is not None:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+else:
+    _encoding = None
+
+def count_text_tokens(text: str | None) -> int:
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    # without tiktoken: about 4 characters per token for English text and JSON
+    return (len(text) + 3) // 4
+
+def count_tokens(api_messages: list) -> int:
+    """Estimates the prompt tokens of a list of api messages (text, tool calls and images)."""
+    tokens = 0
+    for api_message in api_messages:
+        tokens += MESSAGE_OVERHEAD_TOKENS
+        content = api_message.get("content")
+        if isinstance(content, str):
+            tokens += count_text_tokens(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "image_url":
+                    tokens += IMAGE_TOKENS.get(part["image_url"].get("detail", "auto"), IMAGE_TOKENS["high"])
+                else:
+                    tokens += count_text_tokens(part.get("text"))
+        for tool_call in api_message.get("tool_calls") or []:
+            function = tool_call.get("function") or {}
+            tokens += count_text_tokens(function.get("name")) + count_text_tokens(function.get("arguments"))
+    return tokens
+
+# Compaction levels, each one includes the ones before it
+KEEP, DROP_IMAGES, TRUNCATE_TOOL_RESULTS, DROP = range(4)
+
+def _is_pinned(api_messages):
+    return bool(api_messages) and all(api_message.get("role") in ("system", "developer") for api_message in api_messages)
+
+def _is_user_turn(api_messages):
+    # a message typed by the user, the image messages following tool results are user messages too
+    return bool(api_messages) and api_messages[0].get("role") == "user" and isinstance(api_messages[0].get("content"), str)
+
+class ContextStats:
+    """Token accounting of the context windows of all threads."""
+
+    def __init__(self):
+        self.turns = 0
+        self.compacted_turns = 0
+        self.history_tokens = 0
+        self.sent_tokens = 0
+
+    def record(self, report):
+        self.turns += 1
+        self.compacted_turns += int(report["compacted"] > 0)
+        self.history_tokens += report["history_tokens"]
+        self.sent_tokens += report["sent_tokens"]
+
+    def stats(self):
+        return {
+            "turns": self.turns,
+            "compacted_turns": self.compacted_turns,
+            "history_tokens": self.history_tokens,
+            "sent_tokens": self.sent_tokens,
+            "saved_tokens": self.history_tokens - self.sent_tokens
+        }
+
+class ContextWindow:
+    """Fits the history of a thread into a token budget before it is sent to the model.
+
+    Below budget tokens the history goes out unchanged. Above it, messages older than the last
+    keep_recent_turns user turns are compacted oldest first until the history is back under target
+    tokens: images are replaced by a note, then long tool results are truncated, then whole turns are
+    dropped. System and developer messages are pinned. Compacted messages stay compacted for the rest of
+    the thread, so the prompt prefix only changes when the budget is exceeded again."""
+
+    def __init__(self, thread_id, budget, target, keep_recent_turns, tool_result_chars):
+        self.thread_id = thread_id
+        self.budget = budget
+        self.target = min(target, budget)
+        self.keep_recent_turns = max(keep_recent_turns, 1)
+        self.tool_result_chars = tool_result_chars
+        self.logger = logging.getLogger(f"ContextWindow-{thread_id}")
+
+        # message id -> (original api messages, level, compacted api messages, tokens), keyed by content
+        # rather than row version, since state changes bump the version without touching the messages
+        self.compacted = {}
+
+    def _compact(self, api_messages, level):
+        if level >= DROP:
+            return []
+
+        compacted = []
+        for api_message in api_messages:
+            content = api_message.get("content")
+            if isinstance(content, list):
+                images = sum(1 for part in content if part.get("type") == "image_url")
+                if images:
+                    texts = [part for part in content if part.get("type") != "image_url"]
+                    note = {"type": "text", "text": f"[{images} images removed from the context, call the tool again to see them]"}
+                    api_message = {**api_message, "content": texts + [note]}
+            elif level >= TRUNCATE_TOOL_RESULTS and api_message.get("role") == "tool" \
+                    and isinstance(content, str) and len(content) > self.tool_result_chars:
+                truncated = len(content) - self.tool_result_chars
+                api_message = {**api_message, "content": f"{content[:self.tool_result_chars]}... [{truncated} characters of this earlier tool result removed from the context]"}
+            compacted.append(api_message)
+        return compacted
+
+    def build(self, entries: list) -> tuple[list, dict]:
+        """Returns the api messages to send for the (message id, version, api messages, tokens) entries
+        of the thread, and a report of the tokens of the full history, the tokens sent and the number of
+        messages compacted in this turn."""
+        current = []
+        for message_id, _, api_messages, tokens in entries:
+            level = KEEP
+            cached = self.compacted.get(message_id)
+            if cached and cached[0] == api_messages:
+                _, level, api_messages, tokens = cached
+            current.append([level, api_messages, tokens])
+
+        history_tokens = sum(entry[3] for entry in entries)
+        total = sum(tokens for _, _, tokens in current)
+        pinned = {i for i, entry in enumerate(entries) if _is_pinned(entry[2])}
+
+        compacted = set()
+        def compact(i, level):
+            nonlocal total
+            if current[i][0] >= level:
+                return
+            message_id, _, original, _ = entries[i]
+            api_messages = self._compact(original, level)
+            tokens = count_tokens(api_messages)
+            self.compacted[message_id] = (original, level, api_messages, tokens)
+            total += tokens - current[i][2]
+            current[i] = [level, api_messages, tokens]
+            compacted.add(i)
+
+        if total > self.budget:
+            turn_starts = [i for i, entry in enumerate(entries) if _is_user_turn(entry[2])]
+            recent_start = turn_starts[-self.keep_recent_turns] if len(turn_starts) >= self.keep_recent_turns else 0
+            old = [i for i in range(recent_start) if i not in pinned]
+
+            for level in (DROP_IMAGES, TRUNCATE_TOOL_RESULTS):
+                for i in old:
+                    if total <= self.target:
+                        break
+                    compact(i, level)
+
+            # last resort: whole turns, so that tool calls and their results are dropped together
+            turns = [i for i in turn_starts if i < recent_start] + [recent_start]
+            for start, end in zip(turns, turns[1:]):
+                if total <= self.target:
+                    break
+                for i in range(start, end):
+                    if i not in pinned:
+                        compact(i, DROP)
+
+        api_messages = [api_message for _, messages, _ in current for api_message in messages]
+        dropped = sum(1 for level, _, _ in current if level >= DROP)
+        if dropped:
+            # right after the leading system prompt, so the pinned prefix stays the same
+            position = next((i for i, api_message in enumerate(api_messages) if api_message.get("role") not in ("system", "developer")), len(api_messages))
+            note = {"role": "developer", "content": f"{dropped} earlier messages of this conversation were removed to fit the context window."}
+            api_messages.insert(position, note)
+            total += count_tokens([note])
+
+        report = {
+            "history_tokens": history_tokens,
+            "sent_tokens": total,
+            "saved_tokens": history_tokens - total,
+            "compacted": len(compacted)
+        }
+        if compacted:
+            self.logger.info(f"Compacted {len(compacted)} messages: {history_tokens} -> {total} tokens")
+        context_stats.record(report)
+        return api_messages, report
+
+# Shared by the context windows of all threads
+context_stats = ContextStats()
+
+CONTEXT_BUDGET_TOKENS = int(os.getenv("AGENT_CONTEXT_BUDGET_TOKENS", "64000"))
+CONTEXT_TARGET_TOKENS = int(os.getenv("AGENT_CONTEXT_TARGET_TOKENS", "48000"))
+CONTEXT_KEEP_RECENT_TURNS = int(os.getenv("AGENT_CONTEXT_KEEP_RECENT_TURNS", "2"))
+CONTEXT_TOOL_RESULT_CHARS = int(os.getenv("AGENT_CONTEXT_TOOL_RESULT_CHARS", "2000"))
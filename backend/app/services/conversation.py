@@ -0,0 +1,92 @@
+import json
+import logging
+
+from sqlalchemy.orm import Session
+from ..models import Message
+from .context import count_tokens
+
+
+def order_tool_results(api_messages: list) -> list:
+    """Moves the image messages of tool results behind the last tool message of their assistant turn.
+
+    Each tool result row stores its images as a user message right after its tool message. With parallel
+    tool calls that would put a user message between the tool messages of one assistant message, which
+    the API rejects: every tool call has to be answered before any other message."""
+    ordered = []
+    i = 0
+    while i < len(api_messages):
+        api_message = api_messages[i]
+        ordered.append(api_message)
+        i += 1
+        pending = {tool_call["id"] for tool_call in api_message.get("tool_calls") or []} if api_message.get("role") == "assistant" else set()
+
+        held = []
+        while pending and i < len(api_messages):
+            api_message = api_messages[i]
+            if api_message.get("role") == "tool":
+                ordered.append(api_message)
+                pending.discard(api_message.get("tool_call_id"))
+            elif api_message.get("role") == "user" and isinstance(api_message.get("content"), list):
+                held.append(api_message)
+            else:
+                break
+            i += 1
+        ordered.extend(held)
+    return ordered
+
+
+class ConversationCache:
+    """Append-only in-memory copy of the parsed api_messages of a thread.
+
+    Rows written by the agent are added through put(). On read, the cache is checked against the
+    (id, version) pairs in the database and only rows that are missing or stale are loaded and parsed."""
+
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.logger = logging.getLogger(f"ConversationCache-{thread_id}")
+
+        self.entries = {}  # message id -> (version, parsed api messages, token count)
+        self.order = []  # message ids in conversation order
+
+    @staticmethod
+    def _parse(api_messages):
+        api_messages = json.loads(api_messages) if isinstance(api_messages, str) else api_messages
+        if isinstance(api_messages, list):
+            return api_messages
+        return [api_messages]
+
+    def put(self, message_id, version, api_messages, token_count=None):
+        if message_id not in self.entries:
+            self.order.append(message_id)
+        api_messages = self._parse(api_messages)
+        self.entries[message_id] = (version, api_messages, count_tokens(api_messages) if token_count is None else token_count)
+
+    def touch(self, message_id, version):
+        # the row was updated without changing its api messages
+        if message_id in self.entries:
+            self.entries[message_id] = (version, *self.entries[message_id][1:])
+
+    def _sync(self, session):
+        rows = session.query(Message.id, Message.version) \
+            .filter(Message.thread_id == self.thread_id) \
+            .order_by(Message.created_at, Message.id) \
+            .all()
+
+        stale_ids = [message_id for message_id, version in rows if self.entries.get(message_id, (None,))[0] != version]
+        if stale_ids:
+            self.logger.debug(f"Loading {len(stale_ids)} of {len(rows)} messages from the database")
+            for message_id, version, api_messages, token_count in session.query(Message.id, Message.version, Message.api_messages, Message.token_count) \
+                    .filter(Message.id.in_(stale_ids)):
+                # rows written before token counts were stored are counted once here
+                api_messages = self._parse(api_messages)
+                self.entries[message_id] = (version, api_messages, count_tokens(api_messages) if token_count is None else token_count)
+
+        order = [message_id for message_id, _ in rows]
+        if order != self.order:
+            self.order = order
+            self.entries = {message_id: self.entries[message_id] for message_id in order if message_id in self.entries}
+
+    def get_entries(self, session: Session) -> list:
+        """Returns (message id, version, api messages, token count) per row, in conversation order."""
+        self._sync(session)
+        return [(message_id, *self.entries[message_id]) for message_id in self.order if message_id in self.entries]
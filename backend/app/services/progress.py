@@ -0,0 +1,52 @@
+import asyncio
+
+
+class ProgressChannel:
+    """Debounces the progress updates of a single tool call.
+
+    Only the latest update is kept and it is flushed at most once per window. Updates must arrive on
+    the event loop thread."""
+
+    def __init__(self, flush, window):
+        self.flush_callback = flush
+        self.window = window
+
+        self.latest = None
+        self.timer = None
+        self.last_flush = None
+        self.closed = False
+        self.updates = 0
+        self.flushes = 0
+
+    def update(self, tool_call_result):
+        # a tool that keeps running after it was finalized or interrupted must not re-arm the channel
+        if self.closed:
+            return
+        self.latest = tool_call_result
+        self.updates += 1
+
+        if self.timer is None:
+            loop = asyncio.get_running_loop()
+            delay = 0 if self.last_flush is None else max(0, self.last_flush + self.window - loop.time())
+            self.timer = loop.call_later(delay, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if self.latest is None:
+            return
+
+        latest, self.latest = self.latest, None
+        self.last_flush = asyncio.get_running_loop().time()
+        self.flushes += 1
+        self.flush_callback(latest)
+
+    def close(self):
+        # the final result is written by the caller, a pending progress update would be overwritten anyway
+        self.closed = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.latest = None
@@ -0,0 +1,61 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+class PromptCacheStats:
+    """Provider-side prompt cache usage per thread, taken from the usage block of each completion.
+
+    Completions that reused a cached prompt prefix and completions that did not are timed separately,
+    so the latency saved by the cache can be compared on the same threads."""
+
+    def __init__(self):
+        self.threads = {}
+
+    def record(self, thread_id, usage, latency):
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details else 0
+
+        thread = self.threads.setdefault(thread_id, {
+            "completions": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "hits": 0,
+            "hit_latency": 0.0,
+            "miss_latency": 0.0
+        })
+        thread["completions"] += 1
+        thread["prompt_tokens"] += usage.prompt_tokens
+        thread["cached_tokens"] += cached_tokens
+        if cached_tokens:
+            thread["hits"] += 1
+            thread["hit_latency"] += latency
+        else:
+            thread["miss_latency"] += latency
+        logger.debug(f"Thread {thread_id}: {cached_tokens} of {usage.prompt_tokens} prompt tokens cached, {latency:.2f}s")
+
+    @staticmethod
+    def _summary(thread):
+        misses = thread["completions"] - thread["hits"]
+        return {
+            "completions": thread["completions"],
+            "prompt_tokens": thread["prompt_tokens"],
+            "cached_tokens": thread["cached_tokens"],
+            "cache_hit_ratio": thread["cached_tokens"] / thread["prompt_tokens"] if thread["prompt_tokens"] else 0.0,
+            "avg_hit_latency": thread["hit_latency"] / thread["hits"] if thread["hits"] else None,
+            "avg_miss_latency": thread["miss_latency"] / misses if misses else None
+        }
+
+    def thread_stats(self, thread_id):
+        return self._summary(self.threads[thread_id]) if thread_id in self.threads else None
+
+    def stats(self):
+        total = {key: sum(thread[key] for thread in self.threads.values()) for key in ("completions", "prompt_tokens", "cached_tokens", "hits", "hit_latency", "miss_latency")}
+        return {
+            **self._summary(total),
+            "threads": {thread_id: self._summary(thread) for thread_id, thread in self.threads.items()}
+        }
+
+# Create a single instance to be used across the application
+prompt_cache_stats = PromptCacheStats()
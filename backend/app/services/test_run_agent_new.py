@@ -25,6 +25,7 @@ async def main():
     
     # Create database tables
     models.Base.metadata.create_all(bind=database.engine)
+    database.migrate(database.engine)
     
     print("Entering main()")
     logger.info("Starting test run")
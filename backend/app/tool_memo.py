@@ -0,0 +1,67 @@
+from collections import OrderedDict
+import asyncio
+import os
+import time
+
+from .tool_results import canonical_json
+
+class ToolMemo:
+    """Results of read-only tool calls shared by all threads, kept for the tool's memo_ttl seconds.
+
+    A tool opts in with memo_ttl and lists the global_state keys its result depends on in
+    memo_state_keys (e.g. the signed-in mailbox). Concurrent identical calls share one run, and only
+    completed results are kept. Only tools whose data is not cached further down should opt in: the
+    mail tools read the mailbox mirror, the Bexio tools bexio_cache and the PDF tools the rendered
+    pages of pdf_renderer, and a memo on top of those would only add its TTL to theirs."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+
+        self.entries = OrderedDict()  # key -> (expires at, result), least recently used first
+        self.runs = {}  # key -> running call
+        self.counters = {}
+
+    def key(self, tool, args, global_state) -> str:
+        state = {key: global_state.get(key) for key in getattr(tool, "memo_state_keys", ())}
+        return canonical_json([tool.tool_name, args.model_dump(mode="json"), state])
+
+    def _count(self, tool_name, counter):
+        counters = self.counters.setdefault(tool_name, {"hits": 0, "misses": 0, "shared": 0})
+        counters[counter] += 1
+
+    async def call(self, tool, args, global_state, run):
+        """Returns the memoized result of the call, or runs it with run()."""
+        key = self.key(tool, args, global_state)
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self._count(tool.tool_name, "hits")
+            return entry[1].model_copy()
+
+        if key in self.runs:
+            self._count(tool.tool_name, "shared")
+        else:
+            self._count(tool.tool_name, "misses")
+            self.runs[key] = asyncio.ensure_future(self._run(key, tool, run))
+            self.runs[key].add_done_callback(lambda _: self.runs.pop(key, None))
+        return (await asyncio.shield(self.runs[key])).model_copy()
+
+    async def _run(self, key, tool, run):
+        result = await run()
+        if result.state.value == "completed":
+            self.entries[key] = (time.monotonic() + tool.memo_ttl, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return result
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "in_flight": len(self.runs),
+            "tools": {tool_name: dict(counters) for tool_name, counters in self.counters.items()}
+        }
+
+# Create a single instance to be used across the application
+tool_memo = ToolMemo(max_entries=int(os.getenv("TOOL_MEMO_MAX_ENTRIES", "256")))
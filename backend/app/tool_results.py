@@ -0,0 +1,62 @@
+import json
+import os
+
+from pydantic import BaseModel
+
+class ResultPolicy(BaseModel):
+    """How a tool result is shown to the model. The full result is always kept on the message row."""
+    max_chars: int | None = None  # per page of the result sent to the model, None sends it whole
+    columnar: bool = True  # lists of objects with the same keys as {"columns": [...], "rows": [[...], ...]}
+
+def canonical_json(value) -> str:
+    # sorted keys and no optional whitespace: equal values always serialize to the same text
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+def _is_table(result) -> bool:
+    return isinstance(result, list) and len(result) > 1 \
+        and all(isinstance(row, dict) for row in result) \
+        and all(row.keys() == result[0].keys() for row in result)
+
+def _more(page, tool_call_id, next_offset):
+    page["next_offset"] = next_offset
+    page["more"] = f"Call get_more_results with tool_call_id {tool_call_id} and offset {next_offset} for the next page."
+    return page
+
+def project_result(result, policy: ResultPolicy, tool_call_id: str, offset: int = 0):
+    """Returns the page of the result starting at offset (rows of a table, characters otherwise) that fits the policy."""
+    if _is_table(result):
+        # sorted like the keys of the stored full result, so every page has the same columns
+        columns = sorted(result[0])
+        rows = [[row[column] for column in columns] for row in result] if policy.columnar else result
+        if policy.max_chars is None and policy.columnar:
+            return {"columns": columns, "rows": rows}
+        if policy.max_chars is None:
+            return result
+
+        # as many rows as fit, but at least one so that paging always makes progress
+        size = len(canonical_json(columns)) + 100
+        end = offset
+        while end < len(rows):
+            size += len(canonical_json(rows[end])) + 1
+            if size > policy.max_chars and end > offset:
+                break
+            end += 1
+
+        page = {"columns": columns, "rows": rows[offset:end]} if policy.columnar else {"rows": rows[offset:end]}
+        if offset == 0 and end == len(rows):
+            return page if policy.columnar else result
+        page.update({"offset": offset, "total_rows": len(rows)})
+        return _more(page, tool_call_id, end) if end < len(rows) else page
+
+    if policy.max_chars is None:
+        return result
+    text = canonical_json(result)
+    if offset == 0 and len(text) <= policy.max_chars:
+        return result
+
+    page = {"partial_result": text[offset:offset + policy.max_chars], "offset": offset, "total_chars": len(text)}
+    return _more(page, tool_call_id, offset + policy.max_chars) if offset + policy.max_chars < len(text) else page
+
+DEFAULT_RESULT_POLICY = ResultPolicy(max_chars=int(os.getenv("TOOL_RESULT_MAX_CHARS", "8000")))
+# results that are already a page, e.g. of get_more_results
+RAW_RESULT_POLICY = ResultPolicy(max_chars=None, columnar=False)
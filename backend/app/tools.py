@@ -1,7 +1,5 @@
-import requests
-import msal
 import os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import Literal
 from pydantic import BaseModel, Field
 import asyncio
@@ -10,10 +8,20 @@ import tkinter as tk
 from tkinter import simpledialog
 from sqlalchemy.orm import Session
 import json
+import mimetypes
+import shutil
 from enum import Enum
 
 from .models import Message, Thread
 from . import database as db
+from .pdf_render import pdf_renderer
+from .http_client import http_client, multipart_file
+from .ms_graph_auth import ms_graph_auth, SCOPES
+from .mail_mirror import mail_mirror
+from .attachment_cache import attachment_cache
+from .bexio_cache import bexio_cache, get_accounts as get_bexio_accounts, get_contacts as get_bexio_contacts
+from .tool_memo import tool_memo
+from .tool_results import ResultPolicy, DEFAULT_RESULT_POLICY, RAW_RESULT_POLICY, canonical_json, project_result
 
 class ToolCallState(Enum):
     RUNNING = "running"
@@ -23,26 +31,29 @@ class ToolCallState(Enum):
 
 class ToolCallResult(BaseModel):
     state: ToolCallState
-    result_type: Literal["text", "base64_png_list"] = "text"
+    result_type: Literal["text", "base64_png_list", "image_list"] = "text"
     result: object | None = None
     display_data: str | None = None
+    metadata: dict | None = None
     
 
 class ToolBox:
-    def __init__(self, thread_id: int):
+    def __init__(self, thread_id: int, tools: dict | None = None):
         self.thread_id = thread_id
         
-        self.tools = {}
-        self.global_state = {}
-        
-        with db.SessionLocal() as session:
-            #load thread
-            self.thread = session.query(Thread).filter(Thread.id == thread_id).first()
-            if not self.thread:
-                raise Exception(f"Thread {thread_id} not found")
-            
-            #load toolbox state
-            self.global_state = json.loads(self.thread.toolbox_state)
+        self.tools = dict(tools or {})
+        self._global_state = None
+    
+    @property
+    def global_state(self) -> dict:
+        # loaded on the first tool call, most agents are created without ever calling a tool
+        if self._global_state is None:
+            with db.SessionLocal() as session:
+                toolbox_state = session.query(Thread.toolbox_state).filter(Thread.id == self.thread_id).scalar()
+            if toolbox_state is None:
+                raise Exception(f"Thread {self.thread_id} not found")
+            self._global_state = json.loads(toolbox_state)
+        return self._global_state
             
 
     def add_tool(self, tool):
@@ -50,6 +61,9 @@ class ToolBox:
         
     def get_tools(self):
         return list(self.tools.values())
+    
+    def result_policy(self, tool_name: str) -> ResultPolicy:
+        return getattr(self.tools.get(tool_name), "result_policy", DEFAULT_RESULT_POLICY)
         
     async def call(self, tool_name: str, args: dict, on_update) -> ToolCallResult:
         try:
@@ -58,7 +72,11 @@ class ToolBox:
         
             tool = self.tools[tool_name]
             args = tool.args_model.model_validate_json(args)
-            tool_call_result = await tool.run(args, self.global_state, on_update)
+            if getattr(tool, "memo_ttl", None):
+                # read-only, so there is no state to persist either
+                return await tool_memo.call(tool, args, self.global_state, lambda: self._run(tool, args, on_update))
+            
+            tool_call_result = await self._run(tool, args, on_update)
         
             with db.SessionLocal() as session:
                 thread = session.query(Thread).filter(Thread.id == self.thread_id).first()
@@ -69,6 +87,11 @@ class ToolBox:
         
         except Exception as e:
             return ToolCallResult(result={"error" : str(e)}, state=ToolCallState.ERROR)
+    
+    async def _run(self, tool, args, on_update) -> ToolCallResult:
+        if getattr(tool, "needs_tool_box", False):
+            return await tool.run(args, self.global_state, on_update, self)
+        return await tool.run(args, self.global_state, on_update)
 
 
 class UserInputCMD:
@@ -80,16 +103,20 @@ class UserInputCMD:
     tool_description = "This tool is used to get user input."
     
     async def run(self, args: Args, global_state: dict, on_update) -> ToolCallResult:
+        # the dialog blocks until the user answers, so it runs in a thread
+        user_input = await asyncio.to_thread(self._ask, args.message_to_user)
+        return ToolCallResult(result=user_input, state=ToolCallState.COMPLETED)
+    
+    @staticmethod
+    def _ask(message_to_user):
         root = tk.Tk()
         root.withdraw()  # Hide the main window
         
         try:
-            user_input = simpledialog.askstring("Input", args.message_to_user)
+            return simpledialog.askstring("Input", message_to_user)
         finally:
             root.quit()  # Stop the mainloop
             root.destroy()  # Destroy the window
-        
-        return ToolCallResult(result=user_input, state=ToolCallState.COMPLETED)
     
 # class UserInput:
 #     class Args(BaseModel):
@@ -134,19 +161,22 @@ class AuthenticateMSGraph:
     tool_name = "authenticate_ms_graph"
     tool_description = ""
     args_model = Args
+    # no agent timeout, the sign-in is bounded by the device code's own expires_at (about 15 minutes)
+    timeout = None
 
     async def run(self, args: Args, global_state: dict, on_update) -> ToolCallResult:
-        # Microsoft Graph API endpoints
-        AUTHORITY = f"https://login.microsoftonline.com/{global_state["ms_graph.tenant_id"]}"
-        SCOPES = ["Mail.Read"]
+        # Reuse a cached sign-in of this tenant/client/account if there is one
+        if await ms_graph_auth.get_token(global_state, required=False):
+            global_state.pop("ms_graph.access_token", None)
+            return ToolCallResult(result=None, state=ToolCallState.COMPLETED, display_data="✅ Already signed in, using the cached token.")
 
         display_text = ""
 
-        # Initialize the MSAL client (Public Client)
-        app = msal.PublicClientApplication(global_state["ms_graph.client_id"], authority=AUTHORITY)
+        # The MSAL client shares its token cache with all threads
+        app = await ms_graph_auth.get_app(global_state)
 
         # Start device authentication flow
-        device_flow = app.initiate_device_flow(scopes=SCOPES)
+        device_flow = await asyncio.to_thread(app.initiate_device_flow, scopes=SCOPES)
         if "user_code" not in device_flow:
             raise Exception("Failed to start device flow. Try again.")
 
@@ -155,19 +185,27 @@ class AuthenticateMSGraph:
         display_text += f"Use this code: <code style='font-family: monospace; background-color: #f0f0f0; padding: 2px 4px; border-radius: 4px;'>{device_flow['user_code']}</code>"
         on_update(ToolCallResult(result=None, state=ToolCallState.RUNNING, display_data=display_text))
 
-        # Continuously check if the user has signed in
+        # Poll until the user has signed in. Each poll is a single token request, the wait in between
+        # yields to the event loop and is cancelled when the agent is interrupted.
+        interval = device_flow.get("interval", 5)
         while True:
-            token_response = app.acquire_token_by_device_flow(device_flow)
+            token_response = await asyncio.to_thread(app.acquire_token_by_device_flow, device_flow, exit_condition=lambda flow: True)
             
             if "access_token" in token_response:
                 display_text += "<br>✅ Sign-in detected! Access token acquired."
                 break
-            elif "error" in token_response and token_response["error"] == "authorization_pending":
-                time.sleep(5)  # Wait and retry
+            elif token_response.get("error") in ("authorization_pending", "slow_down"):
+                if token_response["error"] == "slow_down":
+                    interval += 5
+                if time.time() + interval > device_flow.get("expires_at", 0):
+                    raise Exception("The sign-in code expired before the sign-in was completed. Try again.")
+                await asyncio.sleep(interval)  # Wait and retry
             else:
                 raise Exception(f"Authentication failed: {token_response}")
             
-        global_state["ms_graph.access_token"] = token_response["access_token"]
+        # the token cache keeps the tokens, the thread only remembers which account signed in
+        ms_graph_auth.remember(global_state, token_response)
+        global_state.pop("ms_graph.access_token", None)
         
         return ToolCallResult(result=None, state=ToolCallState.COMPLETED, display_data=display_text)
 
@@ -181,18 +219,13 @@ class GetLatestEmail:
     args_model = Args
     
     async def run(self, args: Args, global_state: dict, on_update) -> ToolCallResult:
-        headers = {"Authorization": f"Bearer {global_state['ms_graph.access_token']}"}
-        GRAPH_API_URL = "https://graph.microsoft.com/v1.0/me/messages"
+        # Answered from the local mailbox mirror, the sync only transfers what changed
+        await mail_mirror.sync(global_state)
+        emails = mail_mirror.list_messages(global_state, limit=1)
+        if not emails:
+            raise Exception("No emails found")
 
-        response = requests.get(GRAPH_API_URL, headers=headers)
-
-        # Display emails
-        if response.status_code == 200:
-            emails = response.json().get("value", [])
-        else:
-            raise Exception(f"Error: {response.json()}")
-
-        return ToolCallResult(result={"subject": emails[0]["subject"], "from": emails[0]["from"]["emailAddress"]["address"], "receivedDateTime": emails[0]["receivedDateTime"], "bodyPreview": emails[0]["bodyPreview"]}, state=ToolCallState.COMPLETED)
+        return ToolCallResult(result={"subject": emails[0].subject, "from": emails[0].from_address, "receivedDateTime": emails[0].received_at, "bodyPreview": emails[0].body_preview}, state=ToolCallState.COMPLETED)
     
 class ListEmails:
     class Args(BaseModel):
@@ -204,96 +237,70 @@ class ListEmails:
     args_model = Args
     
     async def run(self, args: Args, global_state: dict, on_update) -> ToolCallResult:
-        headers = {"Authorization": f"Bearer {global_state['ms_graph.access_token']}"}
-        GRAPH_API_URL = "https://graph.microsoft.com/v1.0/me/messages"
-        
         # Calculate the date filter
-        filter_date = datetime.now() - timedelta(days=args.not_older_than_days)
-        filter_date_str = filter_date.strftime("%Y-%m-%dT%H:%M:%SZ")
-        
-        # Build query parameters - using bodyPreview instead of body
-        params = {
-            "$select": "id,subject,from,receivedDateTime,hasAttachments,bodyPreview,attachments",
-            "$orderby": "receivedDateTime desc",
-            "$filter": f"receivedDateTime ge {filter_date_str}",
-            "$expand": "attachments($select=name)",  # Include attachment data
-            "$top": 50  # Number of items per page
-        }
+        filter_date = datetime.now(timezone.utc) - timedelta(days=args.not_older_than_days)
         
-        if args.only_has_attachments:
-            params["$filter"] += " and hasAttachments eq true"
-        
-        all_emails = []
-        
-        while True:
-            # Make the API request
-            response = requests.get(GRAPH_API_URL, headers=headers, params=params)
-            
-            if response.status_code != 200:
-                raise Exception(f"Error fetching emails: {response.json()}")
-            
-            response_data = response.json()
-            emails = response_data.get("value", [])
-            
-            # Format and add emails from this page - using bodyPreview
-            email_list = [{
-                "id": email["id"],
-                "subject": email["subject"],
-                "from": email["from"]["emailAddress"]["address"],
-                "receivedDateTime": email["receivedDateTime"],
-                "hasAttachments": email["hasAttachments"],
-                "bodyPreview": email["bodyPreview"],  # Using preview instead of full body
-                "attachments": [att["name"] for att in email.get("attachments", [])]
-            } for email in emails]
-            
-            all_emails.extend(email_list)
-            
-            # Check if there are more pages
-            if "@odata.nextLink" not in response_data:
-                break
-                
-            # Update URL for next page
-            GRAPH_API_URL = response_data["@odata.nextLink"]
-            params = {}  # Parameters are included in the nextLink URL
-            
-            # Optional: Update progress
+        # Bring the local mailbox mirror up to date, only changes since the last sync are transferred
+        def on_sync_progress(changes):
             on_update(ToolCallResult(
                 state=ToolCallState.RUNNING,
-                display_data=f"Fetched {len(all_emails)} emails so far..."
+                display_data=f"Synced {changes} email changes so far..."
             ))
+        await mail_mirror.sync(global_state, since=filter_date, on_update=on_sync_progress)
+        
+        emails = mail_mirror.list_messages(global_state, since=filter_date, only_has_attachments=args.only_has_attachments)
+        attachments = await mail_mirror.attachments(global_state, [email.id for email in emails if email.has_attachments])
+        
+        # Format emails - using bodyPreview instead of body
+        all_emails = [{
+            "id": email.id,
+            "subject": email.subject,
+            "from": email.from_address,
+            "receivedDateTime": email.received_at,
+            "hasAttachments": bool(email.has_attachments),
+            "bodyPreview": email.body_preview,  # Using preview instead of full body
+            "attachments": [att["name"] for att in attachments.get(email.id, [])]
+        } for email in emails]
         
         return ToolCallResult(
             result=all_emails,
             state=ToolCallState.COMPLETED,
-            display_data=f"Fetched {len(all_emails)} emails so far..."
+            display_data=f"Fetched {len(all_emails)} emails"
         )
 
-def pdf_to_base64_png(pdf_byte_buffer, page_limit=10, dpi=200):
-    """Returns a list of base64 encoded PNG images of the PDF pages."""
-    import fitz as pymupdf
-    import io
-    from PIL import Image
-    import base64
-
-    pdf_document = pymupdf.open(stream=pdf_byte_buffer, filetype="pdf")
-    base64_images = []
-
-    # Calculate the zoom factor based on DPI
-    zoom = dpi / 72  # 72 is the default DPI for PDFs
-    mat = pymupdf.Matrix(zoom, zoom)
-
-    for page_num in range(min(len(pdf_document), page_limit)):
-        page = pdf_document.load_page(page_num)
-        pix = page.get_pixmap(matrix=mat)
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-
-        buffer = io.BytesIO()
-        img.save(buffer, format="PNG")
-        base64_images.append(base64.b64encode(buffer.getvalue()).decode("utf-8"))
-
-    pdf_document.close()
+class GetMoreResults:
+    class Args(BaseModel):
+        tool_call_id: str = Field(description="The id of the tool call whose result was cut off.")
+        offset: int = Field(description="The next_offset given with the previous page of the result.")
+    
+    tool_name = "get_more_results"
+    tool_description = "Returns the next page of a tool result that was too long to be shown at once."
+    args_model = Args
+    needs_tool_box = True
+    result_policy = RAW_RESULT_POLICY
+    
+    async def run(self, args: Args, global_state: dict, on_update, tool_box: ToolBox) -> ToolCallResult:
+        # the full result is kept on the message of the original tool call
+        with db.SessionLocal() as session:
+            message = session.query(Message.tool_name, Message.tool_result) \
+                .filter(Message.tool_call_id == args.tool_call_id, Message.thread_id == tool_box.thread_id) \
+                .first()
+        if message is None or message.tool_result is None:
+            return ToolCallResult(result={"error": f"No result found for tool call {args.tool_call_id}"}, state=ToolCallState.ERROR)
+        try:
+            result = json.loads(message.tool_result)
+        except ValueError:
+            return ToolCallResult(result={"error": f"The result of tool call {args.tool_call_id} cannot be paged"}, state=ToolCallState.ERROR)
+        
+        return ToolCallResult(
+            result=project_result(result, tool_box.result_policy(message.tool_name), args.tool_call_id, max(args.offset, 0)),
+            state=ToolCallState.COMPLETED,
+            display_data=f"Fetched more results of {message.tool_name}"
+        )
 
-    return base64_images
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
 
 class ViewPdfAttachment:
     class Args(BaseModel):
@@ -306,37 +313,21 @@ class ViewPdfAttachment:
     args_model = Args
     
     async def run(self, args: Args, global_state: dict, on_update) -> ToolCallResult:
-        headers = {"Authorization": f"Bearer {global_state['ms_graph.access_token']}"}
-        
-        # First get attachment metadata to get the id
-        metadata_url = f"https://graph.microsoft.com/v1.0/me/messages/{args.email_id}/attachments"
-        metadata_response = requests.get(metadata_url, headers=headers)
-        if metadata_response.status_code != 200:
-            raise Exception(f"Error fetching attachment metadata: {metadata_response.json()}")
-            
-        attachments = metadata_response.json().get("value", [])
-        attachment_id = None
-        for att in attachments:
-            if att["name"] == args.attachment_name:
-                attachment_id = att["id"]
-                break
-                
-        if not attachment_id:
+        # First look up the attachment id, the mailbox mirror keeps the attachment lists
+        attachment = await mail_mirror.find_attachment(global_state, args.email_id, args.attachment_name)
+        if not attachment:
             raise Exception(f"Attachment {args.attachment_name} not found")
         
-        # Download the attachment
-        download_url = f"https://graph.microsoft.com/v1.0/me/messages/{args.email_id}/attachments/{attachment_id}/$value"
-        response = requests.get(download_url, headers=headers)
+        # Download the attachment, or reuse an earlier download of it
+        content = await attachment_cache.read(global_state, args.email_id, attachment)
         
-        if response.status_code != 200:
-            raise Exception(f"Error downloading attachment: {response.status_code}")
-        
-        # Convert PDF to base64 images
-        images = pdf_to_base64_png(response.content, page_limit=args.n_pages)
+        # Render the PDF pages within the image budget
+        pages = await pdf_renderer.render(content, page_limit=args.n_pages)
         
         return ToolCallResult(
-            result_type="base64_png_list",
-            result=images,
+            result_type="image_list",
+            result=[data for data, _ in pages],
+            metadata={"images": [info for _, info in pages]},
             state=ToolCallState.COMPLETED
         )
 
@@ -350,15 +341,15 @@ class ViewPdfFile:
     args_model = Args
     
     async def run(self, args: Args, global_state: dict, on_update) -> ToolCallResult:
-        with open(os.path.join(os.getenv("TOOLS_WORKING_DIR"), args.file_name), "rb") as f:
-            file_content = f.read()
+        file_content = await asyncio.to_thread(_read_file, os.path.join(os.getenv("TOOLS_WORKING_DIR"), args.file_name))
         
-        # Convert PDF to base64 images
-        images = pdf_to_base64_png(file_content, page_limit=args.n_pages)
+        # Render the PDF pages within the image budget
+        pages = await pdf_renderer.render(file_content, page_limit=args.n_pages)
         
         return ToolCallResult(
-            result_type="base64_png_list",
-            result=images,
+            result_type="image_list",
+            result=[data for data, _ in pages],
+            metadata={"images": [info for _, info in pages]},
             state=ToolCallState.COMPLETED
         )
             
@@ -374,34 +365,16 @@ class SaveEmailAttachment:
     args_model = Args
     
     async def run(self, args: Args, global_state: dict, on_update) -> ToolCallResult:
-        headers = {"Authorization": f"Bearer {global_state['ms_graph.access_token']}"}
-        
-        # First get attachment metadata to get the id
-        metadata_url = f"https://graph.microsoft.com/v1.0/me/messages/{args.email_id}/attachments"
-        metadata_response = requests.get(metadata_url, headers=headers)
-        if metadata_response.status_code != 200:
-            raise Exception(f"Error fetching attachment metadata: {metadata_response.json()}")
-            
-        attachments = metadata_response.json().get("value", [])
-        attachment_id = None
-        for att in attachments:
-            if att["name"] == args.attachment_name:
-                attachment_id = att["id"]
-                break
-                
-        if not attachment_id:
+        # First look up the attachment id, the mailbox mirror keeps the attachment lists
+        attachment = await mail_mirror.find_attachment(global_state, args.email_id, args.attachment_name)
+        if not attachment:
             raise Exception(f"Attachment {args.attachment_name} not found")
         
-        # Download the attachment
-        download_url = f"https://graph.microsoft.com/v1.0/me/messages/{args.email_id}/attachments/{attachment_id}/$value"
-        response = requests.get(download_url, headers=headers)
-        
-        if response.status_code != 200:
-            raise Exception(f"Error downloading attachment: {response.status_code}")
+        # Download the attachment, or reuse an earlier download of it
+        cached_path = await attachment_cache.path(global_state, args.email_id, attachment)
         
         # Save the attachment to the working directory
-        with open(os.path.join(os.getenv("TOOLS_WORKING_DIR"), args.file_name), "wb") as f:
-            f.write(response.content)
+        await asyncio.to_thread(shutil.copyfile, cached_path, os.path.join(os.getenv("TOOLS_WORKING_DIR"), args.file_name))
             
         return ToolCallResult(
             result=None,
@@ -428,51 +401,14 @@ class BexioListAccounts:
     args_model = Args
 
     async def run(self, args: Args, global_state: dict, on_update) -> ToolCallResult:
-        headers = {
-            "Accept": "application/json",
-            "Authorization": f"Bearer {os.getenv('BEXIO_PAT')}"
-        }
-
         try:
-            response = requests.get("https://api.bexio.com/2.0/accounts", headers=headers)
-            
-            if response.status_code == 200:
-                accounts = response.json()
-                
-                # filter accounts (is_active=true)
-                accounts = [account for account in accounts if account["is_active"]]
-                # translate account_type to account_type_id
-                account_type_encoding = {
-                    1: "income",
-                    2: "expense",
-                    3: "active",
-                    4: "passive",
-                    5: "complete"
-                }
+            # active accounts, cached and indexed by account type
+            accounts = await get_bexio_accounts(args.account_type)
             
-                simplified_accounts = [
-                    {
-                        "id": account["id"],
-                        "account_no": account["account_no"],
-                        "name": account["name"],  
-                        "account_type": account_type_encoding[account["account_type"]],
-                    }
-                    for account in accounts
-                ]
-                
-                # filter accounts by account_type
-                if args.account_type != "all":
-                    simplified_accounts = [account for account in simplified_accounts if account["account_type"] == args.account_type]
-                
-                return ToolCallResult(
-                    result=simplified_accounts,
-                    state=ToolCallState.COMPLETED
-                )
-            else:
-                return ToolCallResult(
-                    result={"error": f"Failed to fetch accounts: {response.status_code} - {response.text}"},
-                    state=ToolCallState.ERROR
-                )
+            return ToolCallResult(
+                result=list(accounts),
+                state=ToolCallState.COMPLETED
+            )
                 
         except Exception as e:
             return ToolCallResult(
@@ -482,41 +418,21 @@ class BexioListAccounts:
             
 class BexioGetContacts:
     class Args(BaseModel):
-        pass
+        name: str | None = Field(default=None, description="Only return contacts with this name. Case, accents and punctuation are ignored.")
     
     tool_name = "bexio_get_contacts"
-    tool_description = "Lists all contacts from Bexio."
+    tool_description = "Lists all contacts from Bexio, or the contacts with a given name."
     args_model = Args
     
     async def run(self, args: Args, global_state: dict, on_update) -> ToolCallResult:
-        headers = {
-            "Accept": "application/json",
-            "Authorization": f"Bearer {os.getenv('BEXIO_PAT')}"
-        }
-
         try:
-            response = requests.get("https://api.bexio.com/2.0/contact", headers=headers)
+            # cached contact list, looked up through the name index
+            contacts = await get_bexio_contacts(args.name)
             
-            if response.status_code == 200:
-                contacts = response.json()
-                simplified_contacts = [
-                    {
-                        "id": contact["id"],
-                        "name": contact["name_1"],
-                        "address": contact["address"],
-                        "postcode": contact["postcode"]
-                    }
-                    for contact in contacts
-                ]
-                return ToolCallResult(
-                    result=simplified_contacts,
-                    state=ToolCallState.COMPLETED
-                )
-            else:
-                return ToolCallResult(
-                    result={"error": f"Failed to fetch contacts: {response.status_code} - {response.text}"},
-                    state=ToolCallState.ERROR
-                )
+            return ToolCallResult(
+                result=list(contacts),
+                state=ToolCallState.COMPLETED
+            )
                 
         except Exception as e:
             return ToolCallResult(
@@ -572,13 +488,15 @@ class BexioCreateContact:
             payload["remarks"] = args.remarks
 
         try:
-            response = requests.post(
+            response = await http_client.post(
                 "https://api.bexio.com/2.0/contact",
                 json=payload,  # using json parameter to automatically handle JSON encoding
                 headers=headers
             )
             
             if response.status_code in (200, 201):
+                # the cached contact list no longer has all contacts
+                bexio_cache.invalidate("contacts")
                 return ToolCallResult(
                     result=response.json(),
                     state=ToolCallState.COMPLETED
@@ -649,7 +567,7 @@ class BexioCreateInvoicePayable:
             payload["attachment_ids"] = args.file_id
             
         try:
-            response = requests.post(
+            response = await http_client.post(
                 "https://api.bexio.com/4.0/purchase/bills",
                 json=payload,
                 headers=headers
@@ -673,6 +591,14 @@ class BexioCreateInvoicePayable:
                 state=ToolCallState.ERROR
             )
 
+def _upload_progress(on_update, file_name):
+    def on_progress(sent, total):
+        on_update(ToolCallResult(
+            state=ToolCallState.RUNNING,
+            display_data=f"Uploading {file_name} to Bexio: {sent // 1024} of {total // 1024} KB"
+        ))
+    return on_progress
+
 class BexioUploadEmailAttachment:
     class Args(BaseModel):
         email_id: str = Field(description="ID of the email containing the attachment")
@@ -684,35 +610,29 @@ class BexioUploadEmailAttachment:
     
     async def run(self, args: Args, global_state: dict, on_update) -> ToolCallResult:
         # First, download the attachment from MS Graph
-        if "ms_graph.access_token" not in global_state:
+        access_token = await ms_graph_auth.get_token(global_state, required=False)
+        if not access_token:
             return ToolCallResult(
                 result={"error": "Microsoft Graph not authenticated. Please authenticate first."},
                 state=ToolCallState.ERROR
             )
 
-        ms_headers = {
-            "Authorization": f"Bearer {global_state['ms_graph.access_token']}"
-        }
-
-        # Get attachment metadata first to get the name
-        metadata_url = f"https://graph.microsoft.com/v1.0/me/messages/{args.email_id}/attachments/{args.attachment_id}"
-        metadata_response = requests.get(metadata_url, headers=ms_headers)
-        
-        if metadata_response.status_code != 200:
+        # Look up the attachment name in the mirrored attachment list
+        attachment = await mail_mirror.find_attachment(global_state, args.email_id, attachment_id=args.attachment_id)
+        if not attachment:
             return ToolCallResult(
-                result={"error": f"Failed to get attachment metadata: {metadata_response.status_code} - {metadata_response.text}"},
+                result={"error": f"Attachment {args.attachment_id} not found"},
                 state=ToolCallState.ERROR
             )
             
-        attachment_name = metadata_response.json().get("name")
-        
-        # Download the attachment content
-        download_url = f"https://graph.microsoft.com/v1.0/me/messages/{args.email_id}/attachments/{args.attachment_id}/$value"
-        download_response = requests.get(download_url, headers=ms_headers)
+        attachment_name = attachment["name"]
         
-        if download_response.status_code != 200:
+        # Download the attachment to disk, or reuse an earlier download of it
+        try:
+            cached_path = await attachment_cache.path(global_state, args.email_id, attachment)
+        except Exception as e:
             return ToolCallResult(
-                result={"error": f"Failed to download attachment: {download_response.status_code} - {download_response.text}"},
+                result={"error": f"Failed to download attachment: {str(e)}"},
                 state=ToolCallState.ERROR
             )
 
@@ -722,16 +642,18 @@ class BexioUploadEmailAttachment:
             "Authorization": f"Bearer {os.getenv('BEXIO_PAT')}"
         }
 
-        # Create a multipart form-data request with the file
-        files = {
-            'file': (attachment_name, download_response.content)
-        }
-
         try:
-            response = requests.post(
+            # Create a multipart form-data request that streams the file from disk
+            multipart_headers, content_factory = multipart_file(
+                "file", attachment_name, cached_path,
+                content_type=attachment.get("contentType") or "application/octet-stream",
+                on_progress=_upload_progress(on_update, attachment_name)
+            )
+            
+            response = await http_client.post(
                 "https://api.bexio.com/3.0/files",
-                headers=bexio_headers,  # Don't include Content-Type here, requests will set it automatically for multipart
-                files=files
+                headers={**bexio_headers, **multipart_headers},
+                content_factory=content_factory
             )
             
             if response.status_code in (200, 201):
@@ -777,30 +699,31 @@ class BexioUploadFile:
         }
 
         try:
-            # Open and prepare the file for upload
-            with open(file_path, 'rb') as file:
-                files = {
-                    'file': (args.file_name, file)
-                }
-                
-                # Upload to Bexio
-                response = requests.post(
-                    "https://api.bexio.com/3.0/files",
-                    headers=headers,  # Don't include Content-Type here, requests will set it automatically for multipart
-                    files=files
+            # Create a multipart form-data request that streams the file from disk
+            multipart_headers, content_factory = multipart_file(
+                "file", args.file_name, file_path,
+                content_type=mimetypes.guess_type(args.file_name)[0] or "application/octet-stream",
+                on_progress=_upload_progress(on_update, args.file_name)
+            )
+            
+            # Upload to Bexio
+            response = await http_client.post(
+                "https://api.bexio.com/3.0/files",
+                headers={**headers, **multipart_headers},
+                content_factory=content_factory
+            )
+            
+            if response.status_code in (200, 201):
+                return ToolCallResult(
+                    result=response.json(),
+                    state=ToolCallState.COMPLETED,
+                    display_data=f"Successfully uploaded {args.file_name} to Bexio"
+                )
+            else:
+                return ToolCallResult(
+                    result={"error": f"Failed to upload to Bexio: {response.status_code} - {response.text}"},
+                    state=ToolCallState.ERROR
                 )
-                
-                if response.status_code in (200, 201):
-                    return ToolCallResult(
-                        result=response.json(),
-                        state=ToolCallState.COMPLETED,
-                        display_data=f"Successfully uploaded {args.file_name} to Bexio"
-                    )
-                else:
-                    return ToolCallResult(
-                        result={"error": f"Failed to upload to Bexio: {response.status_code} - {response.text}"},
-                        state=ToolCallState.ERROR
-                    )
                     
         except FileNotFoundError:
             return ToolCallResult(
@@ -812,5 +735,59 @@ class BexioUploadFile:
                 result={"error": f"Error uploading file to Bexio: {str(e)}"},
                 state=ToolCallState.ERROR
             )
-        
-        
+
+
+def function_schema(tool) -> dict:
+    properties = tool.args_model.model_json_schema()["properties"]
+    return {
+        "type": "function",
+        "function": {
+            "name": tool.tool_name,
+            "description": tool.tool_description,
+            "parameters": {
+                "type": "object",
+                "properties": properties},
+                "required": list(properties.keys()),
+                "additionalProperties": False
+            },
+            "strict": True
+        }
+
+class ToolRegistry:
+    """The agent's tools, instantiated once per process and shared by all agents with their function schemas.
+
+    Tools keep no per-thread state (that is passed in as global_state), so one instance serves every thread."""
+
+    def __init__(self, tool_classes):
+        self.tool_classes = tool_classes
+        self._tools = None
+        self._schemas = None
+    
+    def tools(self) -> dict:
+        if self._tools is None:
+            self._tools = {tool_class.tool_name: tool_class() for tool_class in self.tool_classes}
+        return self._tools
+    
+    def schemas(self) -> list:
+        # sorted by name, the tools are part of the cached prompt prefix and must not depend on registration order
+        if self._schemas is None:
+            self._schemas = sorted((function_schema(tool) for tool in self.tools().values()), key=lambda schema: schema["function"]["name"])
+        return self._schemas
+
+# Create a single instance to be used across the application
+tool_registry = ToolRegistry([
+    SetupMSGraph,
+    AuthenticateMSGraph,
+    GetLatestEmail,
+    ListEmails,
+    ViewPdfAttachment,
+    ViewPdfFile,
+    SaveEmailAttachment,
+    BexioListAccounts,
+    BexioGetContacts,
+    BexioCreateContact,
+    # BexioUploadEmailAttachment,
+    BexioUploadFile,
+    BexioCreateInvoicePayable,
+    GetMoreResults
+])
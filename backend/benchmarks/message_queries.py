@@ -0,0 +1,121 @@
+"""Per-step query cost of the agent as the messages table grows.
+
+Fills a scratch SQLite database with synthetic messages and times the lookups the agent runs on every
+step: the latest agent state of a thread, a tool call row by tool_call_id, and the (id, version)
+listing the conversation cache validates against.
+
+Usage (from the backend directory):
+    python -m benchmarks.message_queries [--no-index] [sizes ...]
+
+e.g. python -m benchmarks.message_queries 10000 100000 1000000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from app import database
+from app.models import Base, Message, Thread
+
+MESSAGES_PER_THREAD = 200
+BATCH_SIZE = 50000
+REPEATS = 200
+
+
+def fill(engine, n_messages):
+    n_threads = max(1, n_messages // MESSAGES_PER_THREAD)
+    with engine.begin() as connection:
+        connection.execute(Thread.__table__.insert(), [{"title": f"thread {i}", "state": "READY", "toolbox_state": "{}"} for i in range(n_threads)])
+
+        batch = []
+        for i in range(n_messages):
+            batch.append({
+                "thread_id": i % n_threads + 1,
+                "api_messages": '[{"role": "tool", "content": "{}"}]',
+                "agent_state": "await_ai_response",
+                "role": "tool",
+                "content_type": "text",
+                "tool_call_id": f"call_{i}",
+                "version": 1
+            })
+            if len(batch) == BATCH_SIZE:
+                connection.execute(Message.__table__.insert(), batch)
+                batch = []
+        if batch:
+            connection.execute(Message.__table__.insert(), batch)
+    return n_threads
+
+
+def timed(f):
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        f()
+    return (time.perf_counter() - start) / REPEATS * 1000
+
+
+def run(n_messages, with_index):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = create_engine(f"sqlite:///{path}")
+    event.listen(engine, "connect", database._apply_storage_profile)
+
+    Base.metadata.create_all(bind=engine)
+    if not with_index:
+        with engine.begin() as connection:
+            for index in Message.__table__.indexes:
+                index.drop(bind=connection)
+
+    start = time.perf_counter()
+    n_threads = fill(engine, n_messages)
+    fill_time = time.perf_counter() - start
+
+    Session = sessionmaker(bind=engine)
+    session = Session()
+
+    def latest_agent_state():
+        thread_id = random.randint(1, n_threads)
+        session.query(Message.agent_state).filter(Message.thread_id == thread_id) \
+            .order_by(Message.created_at.desc(), Message.id.desc()).limit(1).scalar()
+
+    def tool_call_lookup():
+        session.query(Message).filter(Message.tool_call_id == f"call_{random.randrange(n_messages)}").first()
+
+    def conversation_versions():
+        thread_id = random.randint(1, n_threads)
+        session.query(Message.id, Message.version).filter(Message.thread_id == thread_id) \
+            .order_by(Message.created_at, Message.id).all()
+
+    results = {
+        "latest_agent_state": timed(latest_agent_state),
+        "tool_call_lookup": timed(tool_call_lookup),
+        "conversation_versions": timed(conversation_versions)
+    }
+
+    plans = {}
+    with engine.connect() as connection:
+        plans["latest_agent_state"] = connection.exec_driver_sql(
+            "EXPLAIN QUERY PLAN SELECT agent_state FROM messages WHERE thread_id = 1 ORDER BY created_at DESC, id DESC LIMIT 1").fetchall()
+        plans["tool_call_lookup"] = connection.exec_driver_sql(
+            "EXPLAIN QUERY PLAN SELECT * FROM messages WHERE tool_call_id = 'call_1' LIMIT 1").fetchall()
+
+    session.close()
+    engine.dispose()
+
+    print(f"\n{n_messages} messages in {n_threads} threads ({'with' if with_index else 'without'} indexes, filled in {fill_time:.1f}s)")
+    for name, ms in results.items():
+        print(f"  {name:<24} {ms:8.3f} ms")
+    for name, plan in plans.items():
+        print(f"  plan {name}: {' / '.join(row[-1] for row in plan)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sizes", nargs="*", type=int, default=[10000, 100000, 1000000])
+    parser.add_argument("--no-index", action="store_true", help="drop the message indexes to compare against the old schema")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        run(size, not args.no_index)
@@ -0,0 +1,30 @@
+import pytest
+
+
+@pytest.fixture
+def agent(tmp_path, monkeypatch):
+    # the blob store lives in the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+
+    from sqlalchemy import create_engine
+    from app import models, database as db
+    from app.services.agent_new import Agent
+
+    # a database per test, the app's engine resolves its path when app.database is first imported
+    engine = create_engine(f"sqlite:///{tmp_path / 'sql_app.db'}", connect_args={"check_same_thread": False})
+    monkeypatch.setattr(db, "engine", engine)
+    original_bind = db.SessionLocal.kw["bind"]
+    db.SessionLocal.configure(bind=engine)
+    models.Base.metadata.create_all(bind=engine)
+    db.migrate(engine)
+
+    with db.SessionLocal() as session:
+        thread = models.Thread(title="test thread")
+        session.add(thread)
+        session.commit()
+        thread_id = thread.id
+
+    yield Agent(thread_id)
+    db.SessionLocal.configure(bind=original_bind)
+    engine.dispose()
@@ -0,0 +1,110 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+CONTACTS = [
+    {"id": 1, "name_1": "Müller AG", "address": "Bahnhofstrasse 1", "postcode": "8001"},
+    {"id": 2, "name_1": "Meier & Co.", "address": "Marktgasse 2", "postcode": "3011"}
+]
+
+
+class FakeResponse:
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self.data = data
+        self.text = "error" if status_code != 200 else ""
+
+    def json(self):
+        return self.data
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def bexio(monkeypatch):
+    from app import bexio_cache
+
+    responses = []
+    requests = []
+
+    async def get(url, headers=None):
+        requests.append(url)
+        await asyncio.sleep(0)
+        return responses.pop(0)
+
+    clock = FakeClock()
+    monkeypatch.setattr(bexio_cache.http_client, "get", get)
+    monkeypatch.setattr(bexio_cache, "time", clock)
+    monkeypatch.setattr(bexio_cache, "bexio_cache", bexio_cache.ReferenceCache(ttl=300))
+    return SimpleNamespace(
+        get_contacts=bexio_cache.get_contacts,
+        get_accounts=bexio_cache.get_accounts,
+        cache=bexio_cache.bexio_cache,
+        responses=responses,
+        requests=requests,
+        clock=clock
+    )
+
+
+def test_cached_contacts_are_served_without_a_request(bexio):
+    bexio.responses.append(FakeResponse(200, CONTACTS))
+
+    async def lookups():
+        return await bexio.get_contacts(), await bexio.get_contacts("muller ag"), await bexio.get_contacts("Co. Meier")
+
+    contacts, by_name, by_words = asyncio.run(lookups())
+
+    assert [contact["id"] for contact in contacts] == [1, 2]
+    assert [contact["id"] for contact in by_name] == [1]
+    assert [contact["id"] for contact in by_words] == [2]
+    assert len(bexio.requests) == 1
+    assert bexio.cache.stats()["hits"] == 2
+
+
+def test_concurrent_misses_share_one_load(bexio):
+    bexio.responses.append(FakeResponse(200, CONTACTS))
+
+    async def lookups():
+        return await asyncio.gather(*(bexio.get_contacts() for _ in range(3)))
+
+    results = asyncio.run(lookups())
+
+    assert all(len(contacts) == 2 for contacts in results)
+    assert len(bexio.requests) == 1
+
+
+def test_contacts_are_reloaded_after_the_ttl(bexio):
+    bexio.responses += [FakeResponse(200, CONTACTS[:1]), FakeResponse(200, CONTACTS)]
+
+    assert len(asyncio.run(bexio.get_contacts())) == 1
+    bexio.clock.now += 299
+    assert len(asyncio.run(bexio.get_contacts())) == 1
+    bexio.clock.now += 2
+    assert len(asyncio.run(bexio.get_contacts())) == 2
+    assert len(bexio.requests) == 2
+
+
+def test_a_failed_refresh_is_raised_and_retried(bexio):
+    accounts = [
+        {"id": 1, "account_no": "1020", "name": "Bank", "account_type": 3, "is_active": True},
+        {"id": 2, "account_no": "3200", "name": "Sales", "account_type": 1, "is_active": True},
+        {"id": 3, "account_no": "3201", "name": "Old sales", "account_type": 1, "is_active": False}
+    ]
+    bexio.responses += [FakeResponse(200, accounts), FakeResponse(503), FakeResponse(200, accounts[:1])]
+
+    assert [account["id"] for account in asyncio.run(bexio.get_accounts("income"))] == [2]
+    bexio.clock.now += 301
+    with pytest.raises(Exception, match="Failed to fetch accounts: 503"):
+        asyncio.run(bexio.get_accounts())
+
+    # the failure is not cached, the next call loads again
+    assert [account["id"] for account in asyncio.run(bexio.get_accounts())] == [1]
+    assert len(bexio.requests) == 3
+    assert not bexio.cache.loads
@@ -0,0 +1,136 @@
+import json
+
+SYSTEM = [{"role": "system", "content": "You are a bookkeeping assistant."}]
+TOOL_CALL = {"id": "call_1", "type": "function", "function": {"name": "render_pdf", "arguments": "{\"path\": \"invoice.pdf\"}"}}
+PAGE_IMAGE = {"type": "image_url", "image_url": {"url": "blob:0123", "detail": "high"}}
+
+
+def image_message(text):
+    return {"role": "user", "content": [{"type": "text", "text": text}, PAGE_IMAGE]}
+
+
+def history():
+    from app.services.context import count_tokens
+
+    rows = [
+        SYSTEM,
+        [{"role": "user", "content": "Book the invoice in invoice.pdf"}],
+        [{"role": "assistant", "content": None, "tool_calls": [TOOL_CALL]}],
+        [{"role": "tool", "tool_call_id": "call_1", "content": "x" * 4000}, image_message("Pages of invoice.pdf")],
+        [{"role": "user", "content": "And the next one?"}],
+        [{"role": "assistant", "content": "Which file?"}],
+        [{"role": "user", "content": "credit_note.pdf"}]
+    ]
+    return [(message_id, 1, api_messages, count_tokens(api_messages)) for message_id, api_messages in enumerate(rows, 1)]
+
+
+def context_window(budget, target):
+    from app.services.context import ContextWindow
+
+    return ContextWindow("thread", budget=budget, target=target, keep_recent_turns=1, tool_result_chars=200)
+
+
+def total_tokens(entries):
+    return sum(entry[3] for entry in entries)
+
+
+def test_history_under_the_budget_is_sent_unchanged():
+    entries = history()
+    api_messages, report = context_window(total_tokens(entries), total_tokens(entries)).build(entries)
+
+    assert api_messages == [api_message for entry in entries for api_message in entry[2]]
+    assert report["compacted"] == 0 and report["saved_tokens"] == 0
+
+
+def test_images_are_dropped_before_tool_results_are_truncated():
+    entries = history()
+    total = total_tokens(entries)
+    api_messages, report = context_window(total - 1, total - 500).build(entries)
+
+    assert report["sent_tokens"] <= total - 500
+    assert not any(isinstance(m["content"], list) and PAGE_IMAGE in m["content"] for m in api_messages)
+    assert any(m["role"] == "tool" and m["content"] == "x" * 4000 for m in api_messages)
+
+
+def test_old_turns_are_dropped_last_and_the_recent_turn_is_kept():
+    entries = history()
+    total = total_tokens(entries)
+    api_messages, report = context_window(total - 1, 100).build(entries)
+
+    assert api_messages[0] == SYSTEM[0]
+    assert api_messages[1]["role"] == "developer" and "removed to fit the context window" in api_messages[1]["content"]
+    assert api_messages[-1] == {"role": "user", "content": "credit_note.pdf"}
+    assert not any(m.get("tool_calls") or m["role"] == "tool" for m in api_messages)
+    assert report["sent_tokens"] < total
+
+
+def test_compaction_survives_a_version_bump():
+    entries = history()
+    total = total_tokens(entries)
+    window = context_window(total - 1, total - 500)
+    first, _ = window.build(entries)
+
+    # the same rows after a state change, reloaded from the database with a new version
+    reloaded = [(message_id, version + 1, json.loads(json.dumps(api_messages)), tokens) for message_id, version, api_messages, tokens in entries]
+    second, report = window.build(reloaded)
+
+    assert second == first
+    assert report["compacted"] == 0
+
+
+def test_changed_rows_are_compacted_again():
+    entries = history()
+    total = total_tokens(entries)
+    window = context_window(total - 1, total - 500)
+    window.build(entries)
+
+    changed = [(*entry[:2], [entry[2][0], image_message("Pages of invoice_v2.pdf")], entry[3]) if entry[0] == 4 else entry for entry in entries]
+    api_messages, report = window.build(changed)
+
+    assert report["compacted"] == 1
+    assert any(isinstance(m["content"], list) and m["content"][0]["text"] == "Pages of invoice_v2.pdf" for m in api_messages)
+
+
+def test_images_of_parallel_tool_calls_follow_all_tool_messages():
+    from app.services.conversation import order_tool_results
+
+    assistant = {"role": "assistant", "content": None, "tool_calls": [{**TOOL_CALL, "id": "call_1"}, {**TOOL_CALL, "id": "call_2"}]}
+    api_messages = [
+        {"role": "user", "content": "Compare both invoices"},
+        assistant,
+        {"role": "tool", "tool_call_id": "call_1", "content": "rendered"},
+        image_message("Pages of invoice 1"),
+        {"role": "tool", "tool_call_id": "call_2", "content": "rendered"},
+        image_message("Pages of invoice 2"),
+        {"role": "assistant", "content": "They match."}
+    ]
+
+    ordered = order_tool_results(api_messages)
+
+    assert [m.get("tool_call_id") or m["role"] for m in ordered[:4]] == ["user", "assistant", "call_1", "call_2"]
+    assert [m["content"][0]["text"] for m in ordered[4:6]] == ["Pages of invoice 1", "Pages of invoice 2"]
+    assert ordered[6] == api_messages[6]
+    assert order_tool_results(ordered) == ordered
+
+
+def test_conversation_cache_reloads_only_updated_rows(agent):
+    from app import database as db
+    from app.models import Message
+
+    agent._add_user_message("first")
+    agent._add_user_message("second")
+    with db.SessionLocal() as session:
+        before = agent.conversation.get_entries(session)
+
+        # written by another process, the agent's cache does not know about it
+        row = session.get(Message, before[1][0])
+        row.api_messages = json.dumps([{"role": "user", "content": "second, edited"}])
+        session.commit()
+
+        after = agent.conversation.get_entries(session)
+
+    assert [entry[0] for entry in after] == [entry[0] for entry in before]
+    assert after[1][1] == before[1][1] + 1
+    assert after[1][2] == [{"role": "user", "content": "second, edited"}]
+    # the unchanged row is served from the cache
+    assert after[0][2] is before[0][2]
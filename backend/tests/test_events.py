@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+
+class FakeManager:
+    def __init__(self):
+        self.broadcasts = []
+
+    async def broadcast_to_thread(self, thread_id, message):
+        self.broadcasts.append((message["event_type"], message["message"]["id"]))
+
+
+def message_event(event_type, message_id, content=""):
+    return {"event_type": event_type, "thread_id": 1, "message": {"id": message_id, "content": content}}
+
+
+def deliver(monkeypatch, events, **options):
+    from app import events as events_module
+
+    manager = FakeManager()
+    monkeypatch.setattr(events_module, "manager", manager)
+
+    async def run():
+        bus = events_module.EventBus(**options)
+        bus.start()
+        # enqueued in one go, the consumer only runs once the queue is full
+        for event_data in events:
+            bus._enqueue(1, event_data)
+        await asyncio.sleep(0.01)
+        await bus.stop()
+        return bus
+
+    bus = asyncio.run(run())
+    return manager.broadcasts, bus.stats()
+
+
+@pytest.mark.parametrize("overflow_policy", ["drop_oldest", "drop_newest"])
+def test_inserts_are_never_dropped(monkeypatch, overflow_policy):
+    events = [message_event("message_insert", message_id) for message_id in range(1, 6)]
+    events.append(message_event("message_update", 1, "progress"))
+
+    broadcasts, stats = deliver(monkeypatch, events, max_queue_size=3, overflow_policy=overflow_policy, coalesce=False)
+
+    assert [message_id for event_type, message_id in broadcasts if event_type == "message_insert"] == [1, 2, 3, 4, 5]
+    assert ("message_update", 1) not in broadcasts
+    assert stats["dropped"] == 1
+
+
+def test_drop_oldest_drops_the_oldest_update(monkeypatch):
+    events = [
+        message_event("message_update", 1),
+        message_event("message_insert", 2),
+        message_event("message_update", 3),
+        message_event("message_insert", 4)
+    ]
+
+    broadcasts, stats = deliver(monkeypatch, events, max_queue_size=3, overflow_policy="drop_oldest", coalesce=False)
+
+    assert broadcasts == [("message_insert", 2), ("message_update", 3), ("message_insert", 4)]
+    assert stats["dropped"] == 1 and stats["depth"] == 0
+
+
+def test_drop_newest_keeps_an_insert_over_an_update(monkeypatch):
+    events = [
+        message_event("message_update", 1),
+        message_event("message_update", 2),
+        message_event("message_update", 3),
+        message_event("message_insert", 4)
+    ]
+
+    broadcasts, _ = deliver(monkeypatch, events, max_queue_size=3, overflow_policy="drop_newest", coalesce=False)
+
+    assert broadcasts == [("message_update", 2), ("message_update", 3), ("message_insert", 4)]
+
+
+def test_updates_are_coalesced_into_a_pending_insert(monkeypatch):
+    events = [
+        message_event("message_insert", 1),
+        message_event("message_update", 1, "running"),
+        message_event("message_update", 1, "done")
+    ]
+
+    broadcasts, stats = deliver(monkeypatch, events, max_queue_size=1, overflow_policy="drop_oldest", coalesce=True)
+
+    assert broadcasts == [("message_insert", 1)]
+    assert stats["coalesced"] == 2 and stats["dropped"] == 0
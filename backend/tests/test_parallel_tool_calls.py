@@ -0,0 +1,81 @@
+import asyncio
+import json
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+
+
+def test_images_follow_all_tool_messages_of_parallel_calls(agent):
+    from openai.types.chat import ChatCompletionMessage
+    from app.services.agent_new import AgentState
+    from app.tools import ToolCallResult, ToolCallState
+
+    message = ChatCompletionMessage.model_validate({
+        "role": "assistant",
+        "content": None,
+        "tool_calls": [
+            {"id": "call_a", "type": "function", "function": {"name": "view_pdf_file", "arguments": json.dumps({"file_name": "a.pdf", "n_pages": 1})}},
+            {"id": "call_b", "type": "function", "function": {"name": "bexio_list_accounts", "arguments": json.dumps({"account_type": "all"})}}
+        ]
+    })
+    agent._add_assistant_message(message, "tool_calls")
+    agent._add_tool_result_message("call_a", "view_pdf_file", message.tool_calls[0].function.arguments)
+    agent._add_tool_result_message("call_b", "bexio_list_accounts", message.tool_calls[1].function.arguments)
+
+    # the first call returns images and finishes before the second one
+    agent._Agent__finalize_tool_call_message(
+        "call_a",
+        ToolCallResult(state=ToolCallState.COMPLETED, result_type="image_list", result=[PNG], metadata={"images": [{"detail": "low"}]}),
+        AgentState.AWAIT_TOOL_RESPONSE
+    )
+    agent._Agent__finalize_tool_call_message(
+        "call_b",
+        ToolCallResult(state=ToolCallState.COMPLETED, result=[{"id": 1, "name": "Bank"}])
+    )
+
+    messages = asyncio.run(agent._build_request())["messages"]
+    roles = [(api_message["role"], api_message.get("tool_call_id")) for api_message in messages]
+    assert roles == [
+        ("developer", None),
+        ("assistant", None),
+        ("tool", "call_a"),
+        ("tool", "call_b"),
+        ("user", None)
+    ]
+    assert messages[-1]["content"][0]["image_url"]["url"].startswith("data:image/png;base64,")
+
+
+def test_waiting_for_a_slot_does_not_count_against_the_timeout(agent):
+    from pydantic import BaseModel
+    from app.services.agent_new import EventTypes
+    from app.tools import ToolCallResult, ToolCallState
+
+    class SlowTool:
+        class Args(BaseModel):
+            pass
+
+        tool_name = "slow_tool"
+        tool_description = ""
+        args_model = Args
+        timeout = 0.3
+
+        async def run(self, args, global_state, on_update):
+            await asyncio.sleep(0.1)
+            return ToolCallResult(result="done", state=ToolCallState.COMPLETED)
+
+    agent.tool_box.add_tool(SlowTool())
+    agent.tool_call_semaphore = asyncio.Semaphore(1)
+    events = []
+    agent.handle_event = events.append
+
+    async def run_calls():
+        # five calls of 0.1 s through one slot, the last one waits 0.4 s before it starts
+        for i in range(5):
+            agent._dispatch_tool_call(f"call_{i}", "slow_tool", "{}")
+        await asyncio.gather(*agent.tasks)
+
+    asyncio.run(run_calls())
+
+    assert [event.type for event in events] == [EventTypes.TOOL_RESULT] * 5
+    assert [(tool_call_id, result.state) for tool_call_id, result in (event.data for event in events)] == [
+        (f"call_{i}", ToolCallState.COMPLETED) for i in range(5)
+    ]
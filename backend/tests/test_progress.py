@@ -0,0 +1,46 @@
+import asyncio
+
+
+def run_updates(window, schedule):
+    """Sends each (delay, update) of the schedule to a ProgressChannel and returns the flushes as
+    (time since the first update, update)."""
+    from app.services.progress import ProgressChannel
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        flushes = []
+        channel = ProgressChannel(lambda update: flushes.append((loop.time() - start, update)), window)
+        for delay, update in schedule:
+            await asyncio.sleep(delay)
+            if update is None:
+                channel.close()
+            else:
+                channel.update(update)
+        await asyncio.sleep(window * 2)
+        return flushes, channel
+
+    return asyncio.run(run())
+
+
+def test_first_update_is_flushed_right_away():
+    flushes, channel = run_updates(0.2, [(0, "1 of 10")])
+
+    assert [update for _, update in flushes] == ["1 of 10"]
+    assert flushes[0][0] < 0.05
+
+
+def test_updates_within_the_window_are_debounced_to_the_latest():
+    flushes, channel = run_updates(0.2, [(0, "1 of 10"), (0.02, "2 of 10"), (0.02, "3 of 10"), (0.02, "4 of 10")])
+
+    assert [update for _, update in flushes] == ["1 of 10", "4 of 10"]
+    # the second flush waits for the window after the first one
+    assert flushes[1][0] >= 0.19
+    assert (channel.updates, channel.flushes) == (4, 2)
+
+
+def test_closed_channel_drops_pending_and_later_updates():
+    flushes, channel = run_updates(0.2, [(0, "1 of 10"), (0.02, "2 of 10"), (0, None), (0.02, "3 of 10")])
+
+    assert [update for _, update in flushes] == ["1 of 10"]
+    assert channel.timer is None
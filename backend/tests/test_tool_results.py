@@ -0,0 +1,102 @@
+import asyncio
+import json
+
+from app.tool_results import ResultPolicy, canonical_json, project_result
+
+CONTACTS = [{"id": i, "name": f"Contact {i}", "city": "Zurich" if i % 2 else "Bern"} for i in range(40)]
+
+
+def all_pages(result, policy):
+    pages = [project_result(result, policy, "call_1")]
+    while "next_offset" in pages[-1]:
+        pages.append(project_result(result, policy, "call_1", pages[-1]["next_offset"]))
+    return pages
+
+
+def test_tables_are_sent_as_columns_and_rows():
+    page = project_result(CONTACTS, ResultPolicy(max_chars=None), "call_1")
+
+    assert page["columns"] == ["city", "id", "name"]
+    assert page["rows"][1] == ["Zurich", 1, "Contact 1"]
+    assert len(page["rows"]) == len(CONTACTS)
+
+
+def test_results_within_the_limit_are_sent_unchanged():
+    assert project_result({"id": 1}, ResultPolicy(max_chars=1000), "call_1") == {"id": 1}
+    assert project_result(CONTACTS[:3], ResultPolicy(max_chars=1000, columnar=False), "call_1") == CONTACTS[:3]
+
+
+def test_table_pages_cover_every_row_once():
+    policy = ResultPolicy(max_chars=400)
+    pages = all_pages(CONTACTS, policy)
+
+    assert len(pages) > 1
+    assert all(page["columns"] == ["city", "id", "name"] and page["total_rows"] == len(CONTACTS) for page in pages)
+    assert all(len(canonical_json(page["rows"])) <= policy.max_chars for page in pages)
+    rows = [row for page in pages for row in page["rows"]]
+    assert rows == [[contact["city"], contact["id"], contact["name"]] for contact in CONTACTS]
+    # the last page has no pointer to a next one
+    assert "more" not in pages[-1] and all("get_more_results" in page["more"] for page in pages[:-1])
+
+
+def test_a_row_larger_than_the_limit_still_makes_progress():
+    rows = [{"id": i, "notes": "x" * 500} for i in range(3)]
+    pages = all_pages(rows, ResultPolicy(max_chars=100))
+
+    assert [len(page["rows"]) for page in pages] == [1, 1, 1]
+
+
+def test_text_results_are_cut_into_character_pages():
+    result = {"body": "lorem ipsum " * 100}
+    policy = ResultPolicy(max_chars=250)
+    pages = all_pages(result, policy)
+
+    assert all(len(page["partial_result"]) <= policy.max_chars for page in pages)
+    assert all(page["total_chars"] == len(canonical_json(result)) for page in pages)
+    assert json.loads("".join(page["partial_result"] for page in pages)) == result
+
+
+def test_get_more_results_pages_through_the_stored_result(agent):
+    from pydantic import BaseModel
+    from app.tools import ToolCallResult, ToolCallState
+
+    class ListContacts:
+        class Args(BaseModel):
+            pass
+
+        tool_name = "list_contacts"
+        tool_description = ""
+        args_model = Args
+        result_policy = ResultPolicy(max_chars=400)
+
+    agent.tool_box.add_tool(ListContacts())
+    agent._add_tool_result_message("call_1", "list_contacts", "{}")
+    agent._Agent__finalize_tool_call_message("call_1", ToolCallResult(state=ToolCallState.COMPLETED, result=CONTACTS))
+
+    messages = asyncio.run(agent._build_request())["messages"]
+    page = json.loads(messages[-1]["content"])
+    rows = page["rows"]
+    while "next_offset" in page:
+        more = asyncio.run(agent.tool_box.call(
+            "get_more_results",
+            json.dumps({"tool_call_id": "call_1", "offset": page["next_offset"]}),
+            lambda tool_call_result: None
+        ))
+        assert more.state == ToolCallState.COMPLETED
+        page = more.result
+        rows += page["rows"]
+
+    assert len(rows) == len(CONTACTS)
+    assert [row[1] for row in rows] == [contact["id"] for contact in CONTACTS]
+
+
+def test_get_more_results_of_an_unknown_call(agent):
+    from app.tools import ToolCallState
+
+    result = asyncio.run(agent.tool_box.call(
+        "get_more_results",
+        json.dumps({"tool_call_id": "call_missing", "offset": 0}),
+        lambda tool_call_result: None
+    ))
+
+    assert result.state == ToolCallState.ERROR
@@ -1,9 +1,17 @@
-import React, { useEffect, useState, useRef } from 'react';
+import React, { useEffect, useLayoutEffect, useState, useRef } from 'react';
 import axios from 'axios';
 import DOMPurify from 'dompurify';
 import ReactMarkdown from 'react-markdown';
 import remarkGfm from 'remark-gfm';
 
+const API_BASE_URL = 'http://localhost:8000';
+
+// Image messages reference blobs served by the backend (/api/blobs/<hash>), older ones hold data URLs
+const resolveImageUrl = (url: string) => url.startsWith('/api/') ? `${API_BASE_URL}${url}` : url;
+
+// Messages per history page, older pages are loaded when the user scrolls up
+const MESSAGES_PAGE_SIZE = 50;
+
 interface Thread {
   id: number;
   title: string;
@@ -12,6 +20,7 @@ interface Thread {
 
 interface Message {
   id: number;
+  thread_id?: number;
   role: 'assistant' | 'tool' | 'user' | 'developer';
   content?: string;
   content_type?: string;
@@ -23,6 +32,41 @@ interface Message {
   tool_args?: string;
 }
 
+// History pages leave out the URLs of image messages, they are fetched once the images are shown
+const MessageImages = ({ message, children }: { message: Message; children: (imageUrls: string[]) => React.ReactNode }) => {
+  const [imageUrls, setImageUrls] = useState<string[] | null>(null);
+  const [failed, setFailed] = useState(false);
+
+  useEffect(() => {
+    if (message.content) {
+      try {
+        setImageUrls(JSON.parse(message.content).map(resolveImageUrl));
+      } catch (e) {
+        console.error('Error parsing image URLs:', e);
+        setFailed(true);
+      }
+      return;
+    }
+
+    let cancelled = false;
+    axios.get(`${API_BASE_URL}/api/threads/${message.thread_id}/messages/${message.id}/images`)
+      .then(response => {
+        if (!cancelled) setImageUrls(response.data.urls.map(resolveImageUrl));
+      })
+      .catch(error => {
+        console.error('Error fetching message images:', error);
+        if (!cancelled) setFailed(true);
+      });
+    return () => {
+      cancelled = true;
+    };
+  }, [message.id, message.thread_id, message.content]);
+
+  if (failed) return <div className="text-red-500">Error displaying images</div>;
+  if (!imageUrls) return <div className="text-sm text-gray-500">Loading images...</div>;
+  return <>{children(imageUrls)}</>;
+};
+
 interface NonUserMessageGroupProps {
   group: Message[];
   renderMessage: (message: Message) => React.ReactNode;
@@ -38,48 +82,46 @@ const NonUserMessageGroup: React.FC<NonUserMessageGroupProps> = ({ group, render
   const isAwaitingInput = finalMessage?.agent_state === 'await_input';
   
   const renderContent = (message: Message) => {
-    if (!message.content) return null;
-
     if (message.content_type === 'image_url_list') {
-      try {
-        const imageUrls = JSON.parse(message.content);
-        return (
-          <>
-            <div className="mt-2 overflow-x-auto">
-              <div className="flex space-x-4 pb-2">
-                {imageUrls.map((url: string, index: number) => (
-                  <div key={index} className="relative cursor-pointer flex-shrink-0 w-48 h-48">
-                    <img 
-                      src={url} 
-                      alt={`Image ${index + 1}`}
-                      className="w-full h-full object-contain rounded-md hover:opacity-90 transition-opacity border border-gray-200"
-                      loading="lazy"
-                      onClick={() => setSelectedImage(url)}
-                    />
-                  </div>
-                ))}
-              </div>
-            </div>
-            {selectedImage && (
-              <div 
-                className="fixed inset-0 bg-black bg-opacity-75 flex items-center justify-center z-50 p-4"
-                onClick={() => setSelectedImage(null)}
-              >
-                <img 
-                  src={selectedImage} 
-                  alt="Full size"
-                  className="max-w-full max-h-full object-contain"
-                />
+      return (
+        <MessageImages message={message}>
+          {(imageUrls) => (
+            <>
+              <div className="mt-2 overflow-x-auto">
+                <div className="flex space-x-4 pb-2">
+                  {imageUrls.map((url: string, index: number) => (
+                    <div key={index} className="relative cursor-pointer flex-shrink-0 w-48 h-48">
+                      <img 
+                        src={url} 
+                        alt={`Image ${index + 1}`}
+                        className="w-full h-full object-contain rounded-md hover:opacity-90 transition-opacity border border-gray-200"
+                        loading="lazy"
+                        onClick={() => setSelectedImage(url)}
+                      />
+                    </div>
+                  ))}
+                </div>
               </div>
-            )}
-          </>
-        );
-      } catch (e) {
-        console.error('Error parsing image URLs:', e);
-        return <div className="text-red-500">Error displaying images</div>;
-      }
+              {selectedImage && (
+                <div 
+                  className="fixed inset-0 bg-black bg-opacity-75 flex items-center justify-center z-50 p-4"
+                  onClick={() => setSelectedImage(null)}
+                >
+                  <img 
+                    src={selectedImage} 
+                    alt="Full size"
+                    className="max-w-full max-h-full object-contain"
+                  />
+                </div>
+              )}
+            </>
+          )}
+        </MessageImages>
+      );
     }
 
+    if (!message.content) return null;
+
     // For non-image content, use DOMPurify
     const sanitizedContent = DOMPurify.sanitize(message.content, {
       ADD_ATTR: ['target', 'rel'],
@@ -344,49 +386,47 @@ const ToolMessage = ({ message }: { message: Message }) => {
   const [selectedImage, setSelectedImage] = useState<string | null>(null);
 
   const renderToolContent = () => {
-    if (!message.content) return null;
-
     // Handle view_pdf_attachment tool which returns images
     if (message.content_type === 'image_url_list') {
-      try {
-        const imageUrls = JSON.parse(message.content);
-        return (
-          <>
-            <div className="mt-2 overflow-x-auto">
-              <div className="flex space-x-4 pb-2">
-                {imageUrls.map((url: string, index: number) => (
-                  <div key={index} className="relative cursor-pointer flex-shrink-0 w-48 h-48">
-                    <img 
-                      src={url} 
-                      alt={`PDF page ${index + 1}`}
-                      className="w-full h-full object-contain rounded-md hover:opacity-90 transition-opacity border border-gray-200"
-                      loading="lazy"
-                      onClick={() => setSelectedImage(url)}
-                    />
-                  </div>
-                ))}
-              </div>
-            </div>
-            {selectedImage && (
-              <div 
-                className="fixed inset-0 bg-black bg-opacity-75 flex items-center justify-center z-50 p-4"
-                onClick={() => setSelectedImage(null)}
-              >
-                <img 
-                  src={selectedImage} 
-                  alt="Full size"
-                  className="max-w-full max-h-full object-contain"
-                />
+      return (
+        <MessageImages message={message}>
+          {(imageUrls) => (
+            <>
+              <div className="mt-2 overflow-x-auto">
+                <div className="flex space-x-4 pb-2">
+                  {imageUrls.map((url: string, index: number) => (
+                    <div key={index} className="relative cursor-pointer flex-shrink-0 w-48 h-48">
+                      <img 
+                        src={url} 
+                        alt={`PDF page ${index + 1}`}
+                        className="w-full h-full object-contain rounded-md hover:opacity-90 transition-opacity border border-gray-200"
+                        loading="lazy"
+                        onClick={() => setSelectedImage(url)}
+                      />
+                    </div>
+                  ))}
+                </div>
               </div>
-            )}
-          </>
-        );
-      } catch (e) {
-        console.error('Error parsing image URLs:', e);
-        return <div className="text-red-500">Error displaying PDF pages</div>;
-      }
+              {selectedImage && (
+                <div 
+                  className="fixed inset-0 bg-black bg-opacity-75 flex items-center justify-center z-50 p-4"
+                  onClick={() => setSelectedImage(null)}
+                >
+                  <img 
+                    src={selectedImage} 
+                    alt="Full size"
+                    className="max-w-full max-h-full object-contain"
+                  />
+                </div>
+              )}
+            </>
+          )}
+        </MessageImages>
+      );
     }
 
+    if (!message.content) return null;
+
     // Default content rendering
     const sanitizedContent = DOMPurify.sanitize(message.content, {
       ADD_ATTR: ['target', 'rel'],
@@ -463,18 +503,38 @@ export default function Agents() {
   const [isLoading, setIsLoading] = useState(false);
   const [newMessage, setNewMessage] = useState('');
   const [selectedImage, setSelectedImage] = useState<string | null>(null);
+  // Assistant answer that is still being streamed, replaced by the persisted message once it is inserted
+  const [streamingContent, setStreamingContent] = useState('');
+  // Cursor of the page before the oldest loaded message, null once the whole history is loaded
+  const [olderCursor, setOlderCursor] = useState<number | null>(null);
+  const [isLoadingOlder, setIsLoadingOlder] = useState(false);
   const messagesEndRef = useRef<HTMLDivElement>(null);
+  const messagesContainerRef = useRef<HTMLDivElement>(null);
+  // Scroll height before older messages were prepended, to keep the view where it was
+  const prependedFromHeightRef = useRef<number | null>(null);
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
   };
 
-  // Auto scroll when messages change
-  useEffect(() => {
+  // Auto scroll when messages change, unless older messages were prepended above the view
+  useLayoutEffect(() => {
+    const container = messagesContainerRef.current;
+    if (container && prependedFromHeightRef.current !== null) {
+      container.scrollTop += container.scrollHeight - prependedFromHeightRef.current;
+      prependedFromHeightRef.current = null;
+      return;
+    }
     scrollToBottom();
-  }, [messages]);
+  }, [messages, streamingContent]);
 
-  const API_BASE_URL = 'http://localhost:8000';
+  // A first page that does not fill the view cannot be scrolled, load older pages right away
+  useEffect(() => {
+    const container = messagesContainerRef.current;
+    if (container && container.scrollHeight <= container.clientHeight) {
+      loadOlderMessages();
+    }
+  }, [messages, olderCursor]);
 
   useEffect(() => {
     fetchThreads();
@@ -524,8 +584,13 @@ export default function Agents() {
                     // Handle both "type" and "event_type" formats
                     const eventType = data.event_type || data.type;
                     
-                    if (eventType === 'message_insert' && data.message) {
+                    if (eventType === 'message_delta') {
+                        setStreamingContent(prev => prev + data.delta);
+                    } else if (eventType === 'message_insert' && data.message) {
                         console.log('New message received, adding to UI:', data.message);
+                        if (data.message.role === 'assistant') {
+                            setStreamingContent('');
+                        }
                         addMessage(data.message);
                     } else if (eventType === 'message_update' && data.message) {
                         console.log('Message update received, updating UI:', data.message);
@@ -575,16 +640,50 @@ export default function Agents() {
     }
   };
 
+  // Loads one page of the thread history, the newest one or the one before `beforeId`.
+  // Pages leave out the api_messages payloads and the images, see MessageImages.
+  const fetchMessagesPage = async (threadId: number, beforeId: number | null) => {
+    const response: { data: { messages: Message[]; prev_cursor: number | null } } = await axios.get(
+        `${API_BASE_URL}/api/threads/${threadId}/messages`,
+        { params: { latest: true, before_id: beforeId ?? undefined, limit: MESSAGES_PAGE_SIZE } }
+    );
+    return response.data;
+  };
+
   const fetchThreadMessages = async (threadId: number) => {
     try {
         console.log('Fetching messages for thread:', threadId);
-        const response = await axios.get(
-            `${API_BASE_URL}/api/threads/${threadId}/get_thread_messages`
-        );
-        console.log('Received messages:', response.data);
-        setMessages(response.data);
+        const page = await fetchMessagesPage(threadId, null);
+        console.log('Received messages:', page.messages);
+        setMessages(page.messages);
+        setOlderCursor(page.prev_cursor);
     } catch (error) {
         console.error('Error fetching messages:', error);
+        setError('Failed to load messages');
+    }
+  };
+
+  const loadOlderMessages = async () => {
+    if (!selectedThread || olderCursor === null || isLoadingOlder) return;
+
+    const threadId = selectedThread.id;
+    setIsLoadingOlder(true);
+    try {
+        const page = await fetchMessagesPage(threadId, olderCursor);
+        prependedFromHeightRef.current = messagesContainerRef.current?.scrollHeight ?? null;
+        setMessages(prevMessages => [...page.messages, ...prevMessages]);
+        setOlderCursor(page.prev_cursor);
+    } catch (error) {
+        console.error('Error fetching older messages:', error);
+    } finally {
+        setIsLoadingOlder(false);
+    }
+  };
+
+  const handleMessagesScroll = () => {
+    const container = messagesContainerRef.current;
+    if (container && container.scrollTop < 200) {
+      loadOlderMessages();
     }
   };
 
@@ -646,7 +745,7 @@ export default function Agents() {
 
   const renderMessage = (message: Message) => {
     // Skip messages that are empty, tool calls, or tool messages
-    if (!message.content || 
+    if ((!message.content && message.content_type !== 'image_url_list') || 
         (message.role === 'assistant' && message.tool_call_id) || 
         message.role === 'tool' ||
         message.role === 'developer') {
@@ -659,35 +758,32 @@ export default function Agents() {
     };
 
     const renderContent = () => {
-      if (!message.content) return null;
-
       if (message.content_type === 'image_url_list') {
-        try {
-          const imageUrls = JSON.parse(message.content);
-          if (!imageUrls || imageUrls.length === 0) return null;
-          return (
-            <>
-              <div className="grid grid-cols-2 sm:grid-cols-3 md:grid-cols-4 lg:grid-cols-5 gap-4">
-                {imageUrls.map((url: string, index: number) => (
-                  <div key={index} className="relative cursor-pointer">
-                    <img 
-                      src={url} 
-                      alt={`Generated image ${index + 1}`}
-                      className="w-32 h-32 object-contain rounded-lg hover:shadow-lg transition-shadow border border-gray-200"
-                      loading="lazy"
-                      onClick={() => setSelectedImage(url)}
-                    />
-                  </div>
-                ))}
-              </div>
-            </>
-          );
-        } catch (e) {
-          console.error('Error parsing image URLs:', e);
-          return null;
-        }
+        return (
+          <MessageImages message={message}>
+            {(imageUrls) => (
+              <>
+                <div className="grid grid-cols-2 sm:grid-cols-3 md:grid-cols-4 lg:grid-cols-5 gap-4">
+                  {imageUrls.map((url: string, index: number) => (
+                    <div key={index} className="relative cursor-pointer">
+                      <img 
+                        src={url} 
+                        alt={`Generated image ${index + 1}`}
+                        className="w-32 h-32 object-contain rounded-lg hover:shadow-lg transition-shadow border border-gray-200"
+                        loading="lazy"
+                        onClick={() => setSelectedImage(url)}
+                      />
+                    </div>
+                  ))}
+                </div>
+              </>
+            )}
+          </MessageImages>
+        );
       }
 
+      if (!message.content) return null;
+
       // For assistant messages, use ReactMarkdown with GFM support
       if (message.role === 'assistant') {
         return (
@@ -808,21 +904,13 @@ export default function Agents() {
     );
   };
 
-  const handleThreadSelect = async (thread: Thread) => {
+  const handleThreadSelect = (thread: Thread) => {
+    // the history is loaded by the effect on selectedThread
+    if (thread.id === selectedThread?.id) return;
     setSelectedThread(thread);
     setMessages([]); // Clear existing messages
-    
-    try {
-        const response = await axios.get(
-            `${API_BASE_URL}/api/threads/${thread.id}/get_thread_messages`
-        );
-        response.data.forEach((msg: Message) => {
-            addMessage(msg);
-        });
-    } catch (error) {
-        console.error('Error fetching messages:', error);
-        setError('Failed to load messages');
-    }
+    setOlderCursor(null);
+    setStreamingContent('');
   };
 
   return (
@@ -875,7 +963,7 @@ export default function Agents() {
           </div>
         )}
         
-        <div className="flex-1 overflow-y-auto p-6 bg-gray-50">
+        <div ref={messagesContainerRef} onScroll={handleMessagesScroll} className="flex-1 overflow-y-auto p-6 bg-gray-50">
           {error && (
             <div className="border border-gray-200 text-gray-700 px-4 py-3 rounded-lg mb-4">
               {error}
@@ -883,6 +971,9 @@ export default function Agents() {
           )}
           {selectedThread ? (
             <div className="space-y-4 max-w-3xl mx-auto pb-24">
+              {isLoadingOlder && (
+                <div className="text-center text-sm text-gray-500">Loading earlier messages...</div>
+              )}
               {(() => {
                 const messageGroups: (Message | Message[])[] = [];
                 let currentNonUserGroup: Message[] = [];
@@ -937,6 +1028,11 @@ export default function Agents() {
                   }
                 });
               })()}
+              {streamingContent && (
+                <div className="prose prose-blue max-w-none">
+                  <ReactMarkdown children={streamingContent} remarkPlugins={[remarkGfm]} />
+                </div>
+              )}
               <div ref={messagesEndRef} />
             </div>
           ) : (